@@ -6,7 +6,17 @@
 # Purpose: To add type B uncertainties to DynAdjust .apu and .xyz files.
 #
 # ----------------------------------------------------------------------
-#   Usage: CMD:\> python DynAdjust_TypeB.py <*.adj_file> <*.apu_file> <*.xyz_file>
+#   Usage: CMD:\> python DynAdjust_TypeB.py [--compress {gz,xz}]
+#                           [--mmap] [-j N]
+#                           <*.adj_file> <*.apu_file> <*.xyz_file>
+#
+#          The input files may be gzip, Unix compress or xz compressed.
+#          --compress writes the .TypeB output files with gzip or xz
+#          compression, named *.TypeB.gz or *.TypeB.xz.
+#
+#          --mmap memory-maps an uncompressed .apu file, which is written
+#          back uncompressed, and copies everything but the station
+#          variances as raw bytes. -j N does the same on N processes.
 #
 # ----------------------------------------------------------------------
 #   Notes: Adapted from Craig Harrison's addTypeB_AWG.py script to work
@@ -14,16 +24,36 @@
 #
 #-----------------------------------------------------------------------
 
-import sys
 import os
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import io
+import mmap
+import re
+import shutil
+import tempfile
 import math as m
 import geodepy
 import geodepy.convert as gc
-import geodepy.transform as gt
 import numpy as np
+from compressed_io import compression_of, open_file
 
 
 
+def typeB_name(fileName, compression):
+    """Returns the name of the Type B output file for an input file, which
+    drops any compression extension of the input file
+    """
+    root, ext = os.path.splitext(fileName)
+    if ext in ('.gz', '.Z', '.xz'):
+        fileName = root
+    fileName += '.TypeB'
+    if compression:
+        fileName += '.' + compression
+    return fileName
+
+
 def rotation_matrix(lat, lon):
     """Returns the 3x3 rotation matrix for a given latitude and longitude
     (given in decimal degrees)
@@ -86,13 +116,306 @@ def circ_hz_pu(a, b):
     r = a * k
     return r
 
+
+def rotation_matrices(lat, lon):
+    """Returns the N x 3 x 3 rotation matrices for arrays of N latitudes and
+    longitudes (given in decimal degrees), as rotation_matrix does for one
+    """
+    rlat = np.radians(lat)
+    rlon = np.radians(lon)
+    rot_matrices = np.empty((len(rlat), 3, 3))
+    rot_matrices[:, 0, 0] = -np.sin(rlon)
+    rot_matrices[:, 0, 1] = -np.sin(rlat)*np.cos(rlon)
+    rot_matrices[:, 0, 2] = np.cos(rlat)*np.cos(rlon)
+    rot_matrices[:, 1, 0] = np.cos(rlon)
+    rot_matrices[:, 1, 1] = -np.sin(rlat)*np.sin(rlon)
+    rot_matrices[:, 1, 2] = np.cos(rlat)*np.sin(rlon)
+    rot_matrices[:, 2, 0] = 0.0
+    rot_matrices[:, 2, 1] = np.cos(rlat)
+    rot_matrices[:, 2, 2] = np.sin(rlat)
+    return rot_matrices
+
+
+def vcvs_cart2local(vcv_cart, rot_matrices):
+    """Transforms N x 3 x 3 VCVs from the Cartesian to the local reference
+    frame with their rotation matrices, as vcv_cart2local does for one.
+    The stacked matmuls multiply in the same order as vcv_cart2local, so the
+    results are identical
+    """
+    rot_trans = np.transpose(rot_matrices, (0, 2, 1))
+    return np.matmul(np.matmul(rot_trans, vcv_cart), rot_matrices)
+
+
+def vcvs_local2cart(vcv_local, rot_matrices):
+    """Transforms N x 3 x 3 VCVs from the local to the Cartesian reference
+    frame with their rotation matrices, as vcv_local2cart does for one
+    """
+    rot_trans = np.transpose(rot_matrices, (0, 2, 1))
+    return np.matmul(np.matmul(rot_matrices, vcv_local), rot_trans)
+
+
+def error_ellipses(vcv):
+    """Calculate the semi-major axes, semi-minor axes, and the orientations of
+    the error ellipses of N x 3 x 3 VCVs, as error_ellipse does for one
+    """
+    z = np.sqrt((vcv[:, 0, 0] - vcv[:, 1, 1])**2 + 4 * vcv[:, 0, 1]**2)
+    a = np.sqrt(0.5 * (vcv[:, 0, 0] + vcv[:, 1, 1] + z))
+    b = np.sqrt(0.5 * (vcv[:, 0, 0] + vcv[:, 1, 1] - z))
+    orientation = 90 - np.degrees(0.5 * np.arctan2((2 * vcv[:, 0, 1]),
+    (vcv[:, 0, 0] - vcv[:, 1, 1])))
+
+    return a, b, orientation
+
+
+def apply_typeB(stns, lat, lon, vcv, rotate_vcv):
+    """Apply the Type B uncertainties to a batch of N stations at once
+
+    vcv is the N x 3 x 3 array of the station VCVs read from the .apu file,
+    in XYZ if rotate_vcv or else in ENU. Returns the station variance lines
+    with the Type B uncertainties applied, and N x 3 arrays of the Type B
+    uncertainties and of the resulting SDs (E, N, U) of the stations
+    """
+    typeB = np.array([(rvsE, rvsN, rvsU) if stn.strip() in rvsStations
+                      else (nonRvsE, nonRvsN, nonRvsU) for stn in stns])
+    diag = np.arange(3)
+
+    # rotate to ENU if necessary, apply type Bs, recalc uncertainties,
+    # then rotate back
+    if rotate_vcv:
+        rot_matrices = rotation_matrices(lat, lon)
+        vcv_local = vcvs_cart2local(vcv, rot_matrices)
+    else:
+        vcv_local = vcv.copy()
+    vcv_local[:, diag, diag] += typeB**2
+    a, b, orient = error_ellipses(vcv_local)
+    hPU = circ_hz_pu(a, b)
+    vPU = np.sqrt(vcv_local[:, 2, 2]) * 1.96
+    sd = np.sqrt(vcv_local[:, diag, diag])
+    if rotate_vcv:
+        vcv_out = vcvs_local2cart(vcv_local, rot_matrices)
+    else:
+        vcv_out = vcv_local
+
+    lines = []
+    rows = zip(stns, lat.tolist(), lon.tolist(), hPU.tolist(), vPU.tolist(),
+               a.tolist(), b.tolist(), orient.tolist(),
+               vcv_out.reshape(-1, 9).tolist())
+    for stn, stnLat, stnLon, stnHPU, stnVPU, stnA, stnB, stnOrient, v in rows:
+        lines.append(
+            '{:20}{:>16.9f}{:>15.9f}{:11.4f}{:11.4f}{:13.4f}{:13.4f}{:13.4f}'
+            '{:>19.9e}{:>19.9e}{:>19.9e}\n'
+            '{:131s}{:>19.9e}{:>19.9e}\n'
+            '{:150s}{:>19.9e}\n'.format(
+                stn, geodepy.transform.dec2hp(stnLat),
+                geodepy.transform.dec2hp(stnLon), stnHPU, stnVPU, stnA, stnB,
+                stnOrient, v[0], v[1], v[2], ' '*131, v[4], v[5], ' '*150,
+                v[8]))
+    return lines, typeB, sd
+
+
+def write_mapped_header(apu, out):
+    """Write the header of a memory-mapped .apu file, up to and including the
+    first line of dashes under the station column headings, to out with the
+    Type B metadata added
+
+    Returns the position of the end of the header, and whether the station
+    VCVs are to be rotated, i.e., are not in ENU
+    """
+    match = dashPattern.search(apu)
+    headerEnd = match.end() if match else len(apu)
+    headerLineCount = 0
+    rotate_vcv = True
+    lines = unix_newlines(apu[:headerEnd]).decode().split('\n')
+    for line in lines[:-1]:
+        if line == '-' * 80:
+            headerLineCount += 1
+            if headerLineCount == 2:
+                out.write(('Type B Uncertainties               3, 3, 6 mm for RVS '
+                           'stations; 6, 6, 12 for non RVS stations. Applied by DynAdjust_TypeB.py '
+                           '(version: {:s}).\n'.format(dateUpdated)).encode())
+        elif line == 'Variance matrix units              ENU':
+            rotate_vcv = False
+        out.write((line + '\n').encode())
+    out.write(lines[-1].encode())
+    return headerEnd, rotate_vcv
+
+
+def unix_newlines(data):
+    """Returns bytes with CRLF and CR line endings changed to LF, as they are
+    when a file is read as text
+    """
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+
+def copy_range(apu, start, end, out):
+    """Write the bytes apu[start:end] to out, copySize bytes at a time, with
+    their line endings changed to LF as the lines copied by the streaming
+    path are. A CRLF line ending is never split between two pieces
+    """
+    pos = start
+    while pos < end:
+        stop = min(pos + copySize, end)
+        if apu[stop - 1:stop] == b'\r' and apu[stop:stop + 1] == b'\n':
+            stop += 1
+        out.write(unix_newlines(apu[pos:stop]))
+        pos = stop
+
+
+def write_mapped_batch(apu, pos, batch, rotate_vcv, out, log, stn_unc):
+    """Apply the Type B uncertainties to a batch of station variance triplets
+    of a memory-mapped .apu file, and write them and the bytes before each of
+    them from pos on to out
+
+    The triplets are given by the positions of the start of their first and
+    second lines and of their end. Returns the position of the end of the
+    last triplet
+    """
+    stns = []
+    lat = []
+    lon = []
+    vcv = []
+    for start, line2Start, end in batch:
+        line = apu[start:line2Start].decode()
+        line2, line3 = apu[line2Start:end].decode().splitlines()[:2]
+        stns.append(line[:20])
+        lat.append(gc.hp2dec(float(line[23:36])))
+        lon.append(gc.hp2dec(float(line[38:51])))
+        xVar = float(line[112:131].strip())
+        xyCoVar = float(line[131:150].strip())
+        xzCoVar = float(line[150:].strip())
+        yVar = float(line2[131:150].strip())
+        yzCoVar = float(line2[150:].strip())
+        zVar = float(line3[150:].strip())
+        vcv.append((xVar, xyCoVar, xzCoVar,
+                    xyCoVar, yVar, yzCoVar,
+                    xzCoVar, yzCoVar, zVar))
+    lines, typeB, sd = apply_typeB(stns, np.array(lat), np.array(lon),
+                                   np.array(vcv).reshape(-1, 3, 3),
+                                   rotate_vcv)
+
+    # update dictionary for .xyz/.adj file update
+    for stn, (E, N, U), (SD_E, SD_N, SD_U) in zip(stns, typeB.tolist(),
+                                                 sd.tolist()):
+        log.write('{:s}{:>8.4f}{:>8.4f}{:>8.4f}\n'.format(stn, E, N, U))
+        stn_unc[stn] = {'SD_E': SD_E, 'SD_N': SD_N, 'SD_U': SD_U}
+
+    for (start, _, end), text in zip(batch, lines):
+        copy_range(apu, pos, start, out)
+        out.write(text.encode())
+        pos = end
+    return pos
+
+
+def write_mapped_apu(apu, start, end, rotate_vcv, out, log, stn_unc):
+    """Write the bytes apu[start:end] of a memory-mapped .apu file, from a
+    line past its header, to out with the Type B uncertainties applied to the
+    station variance triplets
+
+    Only the triplets are decoded. The covariance lines and everything else
+    between them are copied as raw byte ranges, with only their line endings
+    changed to LF. The file must have LF or CRLF line endings. The Type B
+    uncertainties added are written to log and the SDs of the stations added
+    to stn_unc
+    """
+    pos = start
+    batch = []
+    line3Start = apu.find(line3Marker, max(start - 1, 0), end)
+    while line3Start >= 0:
+        line3Start += 1
+        line2Start = max(apu.rfind(b'\n', start, line3Start - 1) + 1, start)
+        line1Start = max(apu.rfind(b'\n', start, line2Start - 1) + 1, start)
+        match = tripletPattern.match(apu, line2Start, end)
+        if match and line1Start < line2Start:
+            batch.append((line1Start, line2Start, match.end()))
+            if len(batch) >= batchSize:
+                pos = write_mapped_batch(apu, pos, batch, rotate_vcv, out,
+                                         log, stn_unc)
+                batch = []
+        line3Start = apu.find(line3Marker, line3Start, end)
+    if batch:
+        pos = write_mapped_batch(apu, pos, batch, rotate_vcv, out, log,
+                                 stn_unc)
+    copy_range(apu, pos, end, out)
+
+
+def mapped_ranges(apu, start, numChunks):
+    """Returns the offsets splitting the bytes of a memory-mapped .apu file
+    from start on into about numChunks ranges of similar size, each
+    starting at the first line of a station variance triplet
+    """
+    offsets = [start]
+    for k in range(1, numChunks):
+        target = start + k * (len(apu) - start) // numChunks
+        line3Start = apu.find(line3Marker, max(target, offsets[-1]))
+        if line3Start < 0:
+            break
+        line2Start = apu.rfind(b'\n', offsets[-1], line3Start) + 1
+        line1Start = apu.rfind(b'\n', offsets[-1], line2Start - 1) + 1
+        if line1Start > offsets[-1]:
+            offsets.append(line1Start)
+    offsets.append(len(apu))
+    return offsets
+
+
+def typeB_apu_range(apuFile, start, end, rotate_vcv):
+    """Returns the bytes from start to end of an uncompressed .apu file, with
+    the Type B uncertainties applied by write_mapped_apu, and the Type B
+    uncertainties added and the SDs of the stations
+    """
+    out = io.BytesIO()
+    log = io.StringIO()
+    stn_unc = {}
+    with open(apuFile, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as apu:
+        write_mapped_apu(apu, start, end, rotate_vcv, out, log, stn_unc)
+    return out.getvalue(), log.getvalue(), stn_unc
+
+
+def write_mapped_apu_parallel(apuFile, apu, start, rotate_vcv, out, log,
+                              stn_unc, jobs):
+    """Write the bytes of a memory-mapped .apu file from start on to out, as
+    write_mapped_apu does, in chunks processed on a pool of jobs processes
+
+    The file is split at station variance triplets into chunks of at most
+    about chunkSize bytes, and at least four per process. The chunks are
+    written in order as they are finished, with no more than two per process
+    held at a time, and the SDs of the stations in each are merged into
+    stn_unc
+    """
+    numChunks = max(4 * jobs, -(-(len(apu) - start) // chunkSize))
+    offsets = mapped_ranges(apu, start, numChunks)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for chunkStart, chunkEnd in zip(offsets[:-1], offsets[1:]):
+            pending.append(pool.submit(typeB_apu_range, apuFile, chunkStart,
+                                       chunkEnd, rotate_vcv))
+            while len(pending) > 2 * jobs or (pending and
+                                              chunkEnd == offsets[-1]):
+                data, chunkLog, chunkUnc = pending.popleft().result()
+                out.write(data)
+                log.write(chunkLog)
+                stn_unc.update(chunkUnc)
+
+
 dateUpdated = '20190522'
 
-adj_file = sys.argv[1]
-apu_file = sys.argv[2]
-xyz_file = sys.argv[3]
+# Number of stations to which the Type B uncertainties are applied at a time,
+# and the most .apu lines kept waiting for them
+batchSize = 10000
+pendingSize = 100000
+
+# Patterns of the line of dashes under the station column headings of a .apu
+# file, and of the second and third lines of a station variance triplet,
+# which hold two numbers and one number. The third line is the only one
+# indented by 150 spaces, so triplets are found by searching for line3Marker.
+# The bytes between triplets are copied copySize bytes at a time
+dashPattern = re.compile(rb'^-{169}\r?\n', re.M)
+tripletPattern = re.compile(rb' +\S+ +\S+ *\r?\n +\S+ *(?:\r?\n|\Z)')
+line3Marker = b'\n' + b' ' * 150
+copySize = 1 << 24
 
-log_fh = open('DynAdjust_TypeB.log','w')
+# Most bytes of a .apu file processed in one piece with --jobs
+chunkSize = 1 << 26
 
 # Set the Type B uncertainties
 rvsE = 0.003
@@ -120,286 +443,292 @@ rvsStations = ['ALBY', 'ALIC_2011201', 'ANDA', 'ARMC', 'ARUB', 'BALA', 'BBOO',
         'YAR2_2013171', 'YEEL', 'YELO_2016082']
 
 
-#---------------------------------------------------
-#              read .apu and apply type B unc.
-#---------------------------------------------------
-
-apu_file_fh = open(apu_file,'r')
-apu_typeB = open(apu_file + '.TypeB','w')
-lineCount = 0
-stnLine = False
-StnLineNo = 100
-header = False
-stn_unc = {}
-typeB_log = ''
-warning_str = ''
-headerLineCount = 0
-rotate_vcv = True
-
-for line in apu_file_fh:
-    lineCount += 1
-    cols = line.split()
-    numCols = len(cols)
-
-    # check for header lines. Append metadata if end of header, print if not.
-    if line == '-' * 80 + '\n':
-        headerLineCount += 1
-        if headerLineCount == 2:
-            print('Type B Uncertainties               3, 3, 6 mm for RVS '
-                  'stations; 6, 6, 12 for non RVS stations. Applied by DynAdjust_TypeB.py '
-                  '(version: {:s}).'.format(dateUpdated), file=apu_typeB)
-            print(line, file=apu_typeB, end='')
-            continue
-        else:
-            print(line, file=apu_typeB, end='')
-            continue
-
-    if line == '-'*169 + '\n':
-        StnLineNo = lineCount + 1
-        print(line, file=apu_typeB, end='')
-        continue
+def main():
+    parser = argparse.ArgumentParser(
+        description='Add Type B uncertainties to DynAdjust .apu, .xyz and .adj '
+        'files')
+    parser.add_argument('adj_file', help='The DynAdjust .adj file')
+    parser.add_argument('apu_file', help='The DynAdjust .apu file')
+    parser.add_argument('xyz_file', help='The DynAdjust .xyz file')
+    parser.add_argument('--compress', dest='compression', choices=['gz', 'xz'],
+                        help='Compress the output files with gzip or xz')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map an uncompressed .apu file and copy '
+                        'everything but the station variances as raw bytes')
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int,
+                        default=1,
+                        help='Process a memory-mapped .apu file in chunks on '
+                        'N processes')
+    args = parser.parse_args()
+
+    adj_file = args.adj_file
+    apu_file = args.apu_file
+    xyz_file = args.xyz_file
+    adj_out = typeB_name(adj_file, args.compression)
+    apu_out = typeB_name(apu_file, args.compression)
+    xyz_out = typeB_name(xyz_file, args.compression)
+
+    log_fh = open('DynAdjust_TypeB.log','w')
+
+    # The Type B uncertainties added and the warnings are streamed to temporary
+    # files as they are found, and copied into the log once it is complete
+    typeB_log_fh = tempfile.TemporaryFile('w+')
+    warning_fh = tempfile.TemporaryFile('w+')
+
+
+    #---------------------------------------------------
+    #              read .apu and apply type B unc.
+    #---------------------------------------------------
+
+    stn_unc = {}
+    mapped = args.mmap or args.jobs > 1
+    if mapped and (args.compression or compression_of(apu_file)):
+        print(' Warning: --mmap and --jobs need an uncompressed .apu file '
+              'written back uncompressed')
+        print('          Processing {:s} serially.'.format(apu_file))
+        mapped = False
+    if mapped and os.path.getsize(apu_file):
+        # Find the station variance triplets in the memory-mapped file, and copy
+        # the bytes between them unchanged, on N processes with --jobs N
+        with open(apu_file, 'rb') as apu_file_fh, \
+                mmap.mmap(apu_file_fh.fileno(), 0,
+                          access=mmap.ACCESS_READ) as apu, \
+                open(apu_out, 'wb') as apu_typeB:
+            headerEnd, rotate_vcv = write_mapped_header(apu, apu_typeB)
+            if args.jobs > 1:
+                write_mapped_apu_parallel(apu_file, apu, headerEnd, rotate_vcv,
+                                          apu_typeB, typeB_log_fh, stn_unc,
+                                          args.jobs)
+            else:
+                write_mapped_apu(apu, headerEnd, len(apu), rotate_vcv,
+                                 apu_typeB, typeB_log_fh, stn_unc)
+    else:
+        apu_file_fh = open_file(apu_file)
+        apu_typeB = open_file(apu_out, 'w', args.compression)
+        lineCount = 0
+        StnLineNo = 100
+        headerLineCount = 0
+        rotate_vcv = True
+
+        # Station variance triplets are collected into batches, which have the Type B
+        # uncertainties applied all at once. Output lines wait in apu_pending, with
+        # None in place of each station of the batch, until their batch is written
+        batch_stns = []
+        batch_lat = []
+        batch_lon = []
+        batch_vcv = []
+        apu_pending = []
+
+        def write_apu_batch():
+            """Apply the Type B uncertainties to the batch of stations, and write out
+            the lines waiting for them
+            """
+            if batch_stns:
+                lines, typeB, sd = apply_typeB(batch_stns, np.array(batch_lat),
+                                               np.array(batch_lon),
+                                               np.array(batch_vcv).reshape(-1, 3, 3),
+                                               rotate_vcv)
+                # update dictionary for .xyz/.adj file update
+                for stn, (E, N, U), (SD_E, SD_N, SD_U) in zip(batch_stns,
+                                                             typeB.tolist(),
+                                                             sd.tolist()):
+                    typeB_log_fh.write('{:s}{:>8.4f}{:>8.4f}{:>8.4f}\n'.format(stn, E, N, U))
+                    stn_unc[stn] = {'SD_E': SD_E, 'SD_N': SD_N, 'SD_U': SD_U}
+                lines = iter(lines)
+                apu_typeB.write(''.join(next(lines) if line is None else line
+                                        for line in apu_pending))
+            else:
+                apu_typeB.write(''.join(apu_pending))
+            del batch_stns[:], batch_lat[:], batch_lon[:], batch_vcv[:]
+            del apu_pending[:]
+
+
+        for line in apu_file_fh:
+            if len(apu_pending) >= pendingSize:
+                write_apu_batch()
+            lineCount += 1
+            cols = line.split()
+            numCols = len(cols)
+
+            # check for header lines. Append metadata if end of header, print if not.
+            if line == '-' * 80 + '\n':
+                headerLineCount += 1
+                if headerLineCount == 2:
+                    apu_pending.append('Type B Uncertainties               3, 3, 6 mm for RVS '
+                          'stations; 6, 6, 12 for non RVS stations. Applied by DynAdjust_TypeB.py '
+                          '(version: {:s}).\n'.format(dateUpdated))
+                    apu_pending.append(line)
+                    continue
+                else:
+                    apu_pending.append(line)
+                    continue
+
+            if line == '-'*169 + '\n':
+                StnLineNo = lineCount + 1
+                apu_pending.append(line)
+                continue
 
-    # Check variance matrix units. Don't rotate if ENU.
-    if line[:35] == 'Variance matrix units              ':
-        if line[35:] == 'ENU\n':
-            rotate_vcv = False
+            # Check variance matrix units. Don't rotate if ENU.
+            if line[:35] == 'Variance matrix units              ':
+                if line[35:] == 'ENU\n':
+                    rotate_vcv = False
 
-    if lineCount >= StnLineNo:
+            if lineCount >= StnLineNo:
         
-        # copy line across for separate VCV block header info
-        if line == '\n':
-            print(line, file=apu_typeB, end='')
-            continue
-        if line[:6] == 'Block ':
-            if len(line) < 20:
-                print(line, file=apu_typeB, end='')
-                continue
-        if line[:36] == 'Station                     Latitude':
-            print(line, file=apu_typeB, end='')
-            continue
+                # copy line across for separate VCV block header info
+                if line == '\n':
+                    apu_pending.append(line)
+                    continue
+                if line[:6] == 'Block ':
+                    if len(line) < 20:
+                        apu_pending.append(line)
+                        continue
+                if line[:36] == 'Station                     Latitude':
+                    apu_pending.append(line)
+                    continue
             
-        # account for station names with spaces.
-        temp = line[0:20]
-        if temp != (' '*20):
-            numCols = len(line[21:].split()) + 1
-
-        # Station variance line 1
-        if numCols == 11:
-            stn = line[:20]
-            lat = gc.hp2dec(float(line[23:36]))
-            lon = gc.hp2dec(float(line[38:51]))
-            hPU = float(line[51:62].strip())
-            vPU = float(line[62:73].strip())
-            semiMajor = float(line[73:86].strip())
-            semiMinor = float(line[86:99].strip())
-            orient = float(line[99:112].strip())
-            xVar = float(line[112:131].strip())
-            xyCoVar = float(line[131:150].strip())
-            xzCoVar = float(line[150:].strip())
-            continue
-
-        # covariance block line
-        elif numCols == 4:
-            print(line, file=apu_typeB, end='')
-            continue
+                # account for station names with spaces.
+                temp = line[0:20]
+                if temp != (' '*20):
+                    numCols = len(line[21:].split()) + 1
+
+                # Station variance line 1
+                if numCols == 11:
+                    stn = line[:20]
+                    lat = gc.hp2dec(float(line[23:36]))
+                    lon = gc.hp2dec(float(line[38:51]))
+                    xVar = float(line[112:131].strip())
+                    xyCoVar = float(line[131:150].strip())
+                    xzCoVar = float(line[150:].strip())
+                    continue
+
+                # covariance block line
+                elif numCols == 4:
+                    apu_pending.append(line)
+                    continue
+
+                # Covariance block line.
+                elif numCols == 3:
+                    apu_pending.append(line)
+                    continue
+
+                # Station variance line 2
+                elif numCols == 2:
+                    yVar = float(line[131:150].strip())
+                    yzCoVar = float(line[150:].strip())
+                    continue
+
+                #  Station variance line 3
+                elif numCols == 1:
+                    # zLine = line
+                    zVar = float(line[150:].strip())
+
+                    # add the station to the batch, to be written in its place
+                    batch_stns.append(stn)
+                    batch_lat.append(lat)
+                    batch_lon.append(lon)
+                    batch_vcv.append((xVar, xyCoVar, xzCoVar,
+                                      xyCoVar, yVar, yzCoVar,
+                                      xzCoVar, yzCoVar, zVar))
+                    apu_pending.append(None)
+                    if len(batch_stns) >= batchSize:
+                        write_apu_batch()
+                    continue
+                else:
+                    apu_pending.append(line)
+            else:
+                apu_pending.append(line)
 
-        # Covariance block line.
-        elif numCols == 3:
-            print(line, file=apu_typeB, end='')
-            continue
+        write_apu_batch()
+        apu_file_fh.close()
+        apu_typeB.close()
 
-        # Station variance line 2
-        elif numCols == 2:
-            yVar = float(line[131:150].strip())
-            yzCoVar = float(line[150:].strip())
-            continue
 
-        #  Station variance line 3
-        elif numCols == 1:
-            # zLine = line
-            zVar = float(line[150:].strip())
+    #---------------------------------------------------
+    #              read .xyz and apply type B unc.
+    #---------------------------------------------------
 
-            # form matrix, rotate to ENU if necessary, apply type Bs,
-            # recalc uncertainties, rotate back, then print.
-            if rotate_vcv:
-                vcv_cart = np.array([[xVar, xyCoVar, xzCoVar],
-                                    [xyCoVar, yVar, yzCoVar],
-                                    [xzCoVar, yzCoVar, zVar]])
+    xyz_file_fh = open_file(xyz_file)
+    lineCount = 0
+    StnLineNo = 100
+    xyz_typeB = open_file(xyz_out, 'w', args.compression)
+    headerLineCount = 0
 
-                vcv_local = vcv_cart2local(vcv_cart, lat, lon)
+    # loop through .xyz file and apply type B StdDevs
+    for line in xyz_file_fh:
+        lineCount += 1
+        cols = line.split()
+        numCols = len(cols)
 
+        #  check for header lines. Append metadata if end of header, print if not.
+        if line == '-' * 80 + '\n':
+            headerLineCount += 1
+            if headerLineCount == 2:
+                print('Type B Uncertainties               3, 3, 6 mm for RVS '
+                      'stations; 6, 6, 12 for non RVS stations. Applied by DynAdjust_TypeB.py '
+                      '(version: {:s}).'.format(dateUpdated), file=xyz_typeB)
+                print(line, file=xyz_typeB, end='')
+                continue
             else:
-                vcv_local = np.array([[xVar, xyCoVar, xzCoVar],
-                                     [xyCoVar, yVar, yzCoVar],
-                                     [xzCoVar, yzCoVar, zVar]])
-
-            # Add the Type B uncertainty
-            if stn.strip() in rvsStations:
-                vcv_local[0, 0] += rvsE**2
-                vcv_local[1, 1] += rvsN**2
-                vcv_local[2, 2] += rvsU**2
-                typeB_log = typeB_log + '{:s}{:>8.4f}{:>8.4f}{:>8.4f}\n'.format(stn,rvsE,rvsN,rvsU)
-            else:
-                vcv_local[0, 0] += nonRvsE**2
-                vcv_local[1, 1] += nonRvsN**2
-                vcv_local[2, 2] += nonRvsU**2
-                typeB_log = typeB_log + '{:s}{:>8.4f}{:>8.4f}{:>8.4f}\n'.format(stn,nonRvsE,nonRvsN,nonRvsU)
-
-            # recalc uncertainty line
-            ellipse = error_ellipse(vcv_local)
-            a = ellipse[0]
-            b = ellipse[1]
-            orient = ellipse[2]
-            hPU = circ_hz_pu(a, b)
-            vPU = m.sqrt(vcv_local[2, 2]) * 1.96
-
-
-            if rotate_vcv:
-                # rotate back to XYZ
-                vcv_cart = vcv_local2cart(vcv_local, lat, lon)
-
-            # write to file
-            typeB_str = '{:20}{:>16.9f}{:>15.9f}{:11.4f}{:11.4f}{:13.4f}{:13.4f}{:13.4f}'. \
-                format(stn, geodepy.transform.dec2hp(lat), geodepy.transform.dec2hp(lon),
-                hPU, vPU, a, b, orient)
-
-            if rotate_vcv:
-                xVar = vcv_cart[0,0]
-                xyCoVar = vcv_cart[0,1]
-                xzCoVar = vcv_cart[0,2]
-                typeB_str = typeB_str + '{:>19.9e}{:>19.9e}{:>19.9e}\n'.format(xVar,xyCoVar,xzCoVar)
-                yVar = vcv_cart[1,1]
-                yzCoVar = vcv_cart[1,2]
-                typeB_str = typeB_str + '{:131s}{:>19.9e}{:>19.9e}\n'.format(' '*131,yVar,yzCoVar)
-                zVar = vcv_cart[2,2]
-                typeB_str = typeB_str + '{:150s}{:>19.9e}'.format(' '*150,zVar)
-                print(typeB_str, file=apu_typeB)
-            else:
-                xVar = vcv_local[0, 0]
-                xyCoVar = vcv_local[0, 1]
-                xzCoVar = vcv_local[0, 2]
-                typeB_str = typeB_str + '{:>19.9e}{:>19.9e}{:>19.9e}\n'.format(xVar, xyCoVar, xzCoVar)
-                yVar = vcv_local[1, 1]
-                yzCoVar = vcv_local[1, 2]
-                typeB_str = typeB_str + '{:131s}{:>19.9e}{:>19.9e}\n'.format(' ' * 131, yVar, yzCoVar)
-                zVar = vcv_local[2, 2]
-                typeB_str = typeB_str + '{:150s}{:>19.9e}'.format(' ' * 150, zVar)
-                print(typeB_str, file=apu_typeB)
-
-            # update dictionary for .xyz/.adj file update
-            stn_unc[stn] = {'SD_E': m.sqrt(vcv_local[0,0]),
-                            'SD_N': m.sqrt(vcv_local[1,1]),
-                            'SD_U': m.sqrt(vcv_local[2,2])
-                            }
+                print(line, file=xyz_typeB, end='')
+                continue
 
-            continue
-        else:
-            print(line, file=apu_typeB, end='')
-    else:
-        print(line, file=apu_typeB, end='')
-
-apu_file_fh.close()
-apu_typeB.close()
-
-
-#---------------------------------------------------
-#              read .xyz and apply type B unc.
-#---------------------------------------------------
-
-xyz_file_fh = open(xyz_file,'r')
-lineCount = 0
-stnLine = False
-StnLineNo = 100
-header = False
-StnListing = False
-xyz_typeB = open(xyz_file + '.TypeB','w')
-headerLineCount = 0
-
-# loop through .xyz file and apply type B StdDevs
-for line in xyz_file_fh:
-    lineCount += 1
-    cols = line.split()
-    numCols = len(cols)
-
-    #  check for header lines. Append metadata if end of header, print if not.
-    if line == '-' * 80 + '\n':
-        headerLineCount += 1
-        if headerLineCount == 2:
-            print('Type B Uncertainties               3, 3, 6 mm for RVS '
-                  'stations; 6, 6, 12 for non RVS stations. Applied by DynAdjust_TypeB.py '
-                  '(version: {:s}).'.format(dateUpdated), file=xyz_typeB)
+        # check coordinate type string is correct:
+        elif line[:35] == 'Station coordinate types:          ':
+            if line[35:] == 'ENzPLHhXYZ\n':
+                print(line, file=xyz_typeB, end='')
+            else:
+                print()
+                print(' Warning: Coordinate types must be ENzPLHhXY')
+                print('          Exiting.')
+                xyz_file_fh.close()
+                xyz_typeB.close()
+                log_fh.close()
+                os.remove(xyz_out)
+                os.remove(apu_out)
+                os.remove('DynAdjust_TypeB.log')
+                exit()
+
+        # determine beginning of station coordinate listing
+        elif line == 'Adjusted Coordinates\n':
+            StnLineNo = lineCount + 5
             print(line, file=xyz_typeB, end='')
             continue
-        else:
-            print(line, file=xyz_typeB, end='')
+        elif lineCount >= StnLineNo:
+            if line == '\n':
+                print(line, file=xyz_typeB, end='')
+                continue
+            stn = line[:20]
+            printStr = line[:158]
+            try:
+                StdStr = '{:12.4f}{:10.4f}{:10.4f}'.format(stn_unc[stn]['SD_E'], stn_unc[stn]['SD_N'],
+                                                           stn_unc[stn]['SD_U'])
+                printStr = printStr + StdStr + line[190:]
+                print(printStr, file=xyz_typeB, end='')
+                # print(stn, StdStr)
+            except:
+                warning_fh.write('{:s} on line {:d} not found in {:s}\n'.format(stn.strip(), lineCount,
+                                                                                 xyz_file))
             continue
 
-    # check coordinate type string is correct:
-    elif line[:35] == 'Station coordinate types:          ':
-        if line[35:] == 'ENzPLHhXYZ\n':
-            print(line, file=xyz_typeB, end='')
         else:
-            print()
-            print(' Warning: Coordinate types must be ENzPLHhXY')
-            print('          Exiting.')
-            xyz_file_fh.close()
-            xyz_typeB.close()
-            log_fh.close()
-            os.remove(xyz_file + '.TypeB')
-            os.remove(apu_file + '.TypeB')
-            os.remove('DynAdjust_TypeB.log')
-            exit()
-
-    # determine beginning of station coordinate listing
-    elif line == 'Adjusted Coordinates\n':
-        StnLineNo = lineCount + 5
-        print(line, file=xyz_typeB, end='')
-        continue
-    elif lineCount >= StnLineNo:
-        if line == '\n':
             print(line, file=xyz_typeB, end='')
-            continue
-        stn = line[:20]
-        printStr = line[:158]
-        try:
-            StdStr = '{:12.4f}{:10.4f}{:10.4f}'.format(stn_unc[stn]['SD_E'], stn_unc[stn]['SD_N'],
-                                                       stn_unc[stn]['SD_U'])
-            printStr = printStr + StdStr + line[190:]
-            print(printStr, file=xyz_typeB, end='')
-            # print(stn, StdStr)
-        except:
-            warning_str = warning_str + '{:s} on line {:d} not found in {:s}\n'.format(stn.strip(), lineCount,
-                                                                                       xyz_file)
-        continue
-
-    else:
-        print(line, file=xyz_typeB, end='')
 
-xyz_typeB.close()
+    xyz_typeB.close()
 
 
-#---------------------------------------------------
-#              read .adj and apply type B unc.
-#---------------------------------------------------
+    #---------------------------------------------------
+    #              read .adj and apply type B unc.
+    #---------------------------------------------------
 
-adj_file_fh = open(adj_file,'r')
-lineCount = 0
-
-# loop through .adj file, find if stations are listed, then and apply type B StdDevs
-for line in adj_file_fh:
-    lineCount += 1
-    if line == 'Adjusted Coordinates\n':
-        StnLineNo = lineCount + 5
-
-adj_file_fh.close()
-
-# if stn listing present in .adj file:
-if StnLineNo > 0:
-    adj_file_fh = open(adj_file, 'r')
-    adj_typeB = open(adj_file + '.TypeB','w')
+    adj_file_fh = open_file(adj_file)
+    adj_typeB = open_file(adj_out, 'w', args.compression)
     lineCount = 0
     headerLineCount = 0
+    StnLineNo = None
 
+    # loop through .adj file once, finding the station listing, if any, as it is
+    # read, and apply type B StdDevs to the stations listed
     for line in adj_file_fh:
         lineCount += 1
 
@@ -415,8 +744,10 @@ if StnLineNo > 0:
             else:
                 print(line,file=adj_typeB, end='')
                 continue
+        if line == 'Adjusted Coordinates\n':
+            StnLineNo = lineCount + 5
         # print line to file if before station listing, else update StdDevs.
-        if lineCount < StnLineNo:
+        if StnLineNo is None or lineCount < StnLineNo:
             print(line,file=adj_typeB, end='')
             continue
         else:
@@ -431,40 +762,48 @@ if StnLineNo > 0:
                 printStr = printStr + StdStr + line[190:]
                 print(printStr, file=adj_typeB,end='')
             except:
-                warning_str = warning_str + '{:s} on line {:d} not found in {:s}\n'.format(stn.strip(), lineCount,
-                                                                                          adj_file)
+                warning_fh.write('{:s} on line {:d} not found in {:s}\n'.format(stn.strip(), lineCount,
+                                                                                 adj_file))
             continue
 
-adj_file_fh.close()
-adj_typeB.close()
+    adj_file_fh.close()
+    adj_typeB.close()
 
 
-#---------------------------------------------------
-# Print program log and summary
-#---------------------------------------------------
+    #---------------------------------------------------
+    # Print program log and summary
+    #---------------------------------------------------
+
+    print('-'*50,file=log_fh)
+    print('DynAdjust_TypeB.py log file',file=log_fh)
+    print('-'*50,file=log_fh)
+    print('Program version         {:s}'.format(dateUpdated),file=log_fh)
+    print('Input Files:            {:s}'.format(adj_file),file=log_fh)
+    print('                        {:s}'.format(apu_file),file=log_fh)
+    print('                        {:s}'.format(xyz_file),file=log_fh)
+    print('-'*50,file=log_fh)
+    print(file=log_fh)
+
+    print('Warnings:',file=log_fh)
+    print('-'*50,file=log_fh)
+    if warning_fh.tell() == 0:
+        print('<None>',file=log_fh)
+    else:
+        warning_fh.seek(0)
+        shutil.copyfileobj(warning_fh, log_fh)
+        print(file=log_fh)
+    print(file=log_fh)
 
-print('-'*50,file=log_fh)
-print('DynAdjust_TypeB.py log file',file=log_fh)
-print('-'*50,file=log_fh)
-print('Program version         {:s}'.format(dateUpdated),file=log_fh)
-print('Input Files:            {:s}'.format(adj_file),file=log_fh)
-print('                        {:s}'.format(apu_file),file=log_fh)
-print('                        {:s}'.format(xyz_file),file=log_fh)
-print('-'*50,file=log_fh)
-print(file=log_fh)
+    print('Type B uncertainties added:',file=log_fh)
+    print('Station                 East   North      Up',file=log_fh)
+    print('-'*50,file=log_fh)
+    typeB_log_fh.seek(0)
+    shutil.copyfileobj(typeB_log_fh, log_fh)
+    print(file=log_fh)
 
-print('Warnings:',file=log_fh)
-print('-'*50,file=log_fh)
-if warning_str == '':
-    print('<None>',file=log_fh)
-else:
-    print(warning_str,file=log_fh)
-print(file=log_fh)
 
-print('Type B uncertainties added:',file=log_fh)
-print('Station                 East   North      Up',file=log_fh)
-print('-'*50,file=log_fh)
-print(typeB_log,file=log_fh)
+    log_fh.close()
 
 
-log_fh.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""
+NAME:
+    benchmark_createBLs.py
+PURPOSE:
+    Time createBLs.py on synthetic SINEX files
+EXPLANATION:
+    Synthetic SINEX files with realistic SOLUTION/ESTIMATE and
+    SOLUTION/MATRIX_ESTIMATE blocks are generated for each station count, and
+    the stages of createBLs.py are timed separately on them:
+        parse    - scanning the SINEX file and converting the text to numbers
+        assemble - building the VCV matrix from the parsed matrix elements
+        deltas   - forming the baselines and their VCV matrix
+        emit     - writing the DynaML station and measurement files
+    Each station count is run in a fresh process so that its peak memory can
+    be reported. The results are written as a JSON report
+USAGE:
+    benchmark_createBLs.py [-n N [N...]] [--form {COVA,CORR,INFO}]
+        [--triangle {L,U}] [--out-of-core] [--repeat R] [--workdir DIR]
+        [--report FILE] [--generate]
+INPUT:
+    None. The synthetic SINEX files are written to the work directory and are
+    reused by later runs with the same settings
+OUTPUT:
+    A JSON report, by default createBLs_benchmark.json. With --generate the
+    synthetic SINEX files are written and nothing is timed
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import createBLs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Rank of the correlated part of the synthetic VCV matrices, and the number
+# of matrix rows computed at a time by the generator
+synthRank = 6
+synthRows = 256
+
+
+def synth_name(workDir, numStations, form, triangle):
+    """Returns the name of the synthetic SINEX file for the settings"""
+    return os.path.join(workDir, 'synth_%05d_%s_%s.snx' %
+                        (numStations, form, triangle))
+
+
+def synth_sinex(fileName, numStations, form='COVA', triangle='L', seed=0):
+    """Write a synthetic SINEX file holding numStations stations
+
+    The stations are spread over the surface of the Earth. Their VCV matrix is
+    diag(d) + B B^T, with standard deviations of a few mm and every station
+    correlated with every other through the rank synthRank matrix B. The
+    matrix is written as the form (COVA, CORR or INFO) and triangle (L or U)
+    given, three elements to a line as in SINEX files from Bernese and GAMIT
+    """
+    rng = np.random.default_rng(seed)
+    size = 3 * numStations
+    xyz = rng.normal(size=(numStations, 3))
+    xyz *= 6371000.0 / np.linalg.norm(xyz, axis=1)[:, np.newaxis]
+    xyz += rng.normal(scale=10.0, size=xyz.shape)
+    d = rng.uniform(1e-6, 4e-6, size)
+    b = rng.normal(scale=1e-3, size=(size, synthRank))
+
+    # Rows of an INFO matrix come from the inverse of diag(d) + B B^T, which
+    # by the Woodbury identity is diag(1/d) - E C E^T
+    if form == 'INFO':
+        e = b / d[:, np.newaxis]
+        c = np.linalg.inv(np.eye(synthRank) + b.T @ e)
+    sd = np.sqrt(d + np.sum(b**2, axis=1))
+
+    with open(fileName, 'w', buffering=createBLs.writeBuffer) as snx:
+        snx.write('%%=SNX 2.02 SYN 20:124:00000 SYN 20:123:00000 '
+                  '20:123:86399 P %05d 2 S\n' % size)
+        snx.write('+FILE/REFERENCE\n'
+                  ' DESCRIPTION        Synthetic solution for benchmarking\n'
+                  '-FILE/REFERENCE\n')
+        snx.write('+SITE/ID\n'
+                  '*CODE PT __DOMES__ T _STATION DESCRIPTION__\n')
+        for i in range(numStations):
+            snx.write(' %-4s  A %9s P %-22s\n' %
+                      (synth_site(i), 'SYN%05d' % i, 'Synthetic'))
+        snx.write('-SITE/ID\n')
+        snx.write('+SOLUTION/ESTIMATE\n'
+                  '*INDEX TYPE__ CODE PT SOLN _REF_EPOCH__ UNIT S '
+                  '__ESTIMATED VALUE____ _STD_DEV___\n')
+        for i in range(numStations):
+            for j, axis in enumerate('XYZ'):
+                snx.write(' %5d %-6s %-4s %2s %4s %12s %-4s %1s %21.14e '
+                          '%11.5e\n' %
+                          (3 * i + j + 1, 'STA' + axis, synth_site(i), 'A',
+                           '1', '20:123:43200', 'm', '2', xyz[i, j],
+                           sd[3 * i + j]))
+        snx.write('-SOLUTION/ESTIMATE\n')
+        snx.write('+SOLUTION/MATRIX_ESTIMATE %s %s\n'
+                  '*PARA1 PARA2 ____PARA2+0__________ ____PARA2+1__________ '
+                  '____PARA2+2__________\n' % (triangle, form))
+        for start in range(0, size, synthRows):
+            rows = np.arange(start, min(start + synthRows, size))
+            if form == 'INFO':
+                block = -(e[rows] @ c @ e.T)
+                block[np.arange(len(rows)), rows] += 1 / d[rows]
+            else:
+                block = b[rows] @ b.T
+                block[np.arange(len(rows)), rows] += d[rows]
+                if form == 'CORR':
+                    block /= sd[rows, np.newaxis] * sd[np.newaxis, :]
+                    block[np.arange(len(rows)), rows] = sd[rows]
+            for i, row in enumerate(rows):
+                if triangle == 'L':
+                    snx.write(matrix_row_text(row, 0, block[i, :row + 1]))
+                else:
+                    snx.write(matrix_row_text(row, row, block[i, row:]))
+        snx.write('-SOLUTION/MATRIX_ESTIMATE %s %s\n' % (triangle, form))
+        snx.write('%ENDSNX\n')
+
+
+def synth_site(i):
+    """Returns the four character site code of synthetic station i"""
+    return '%s%03d' % (chr(65 + i // 1000), i % 1000)
+
+
+def matrix_row_text(row, col, values):
+    """Returns the SINEX matrix lines holding the values of row from col on"""
+    numFull = len(values) // 3
+    table = np.empty((numFull, 5))
+    table[:, 0] = row + 1
+    table[:, 1] = col + 1 + 3 * np.arange(numFull)
+    table[:, 2:] = values[:3 * numFull].reshape(numFull, 3)
+    text = ((' %5d %5d %21.14e %21.14e %21.14e\n' * numFull) %
+            tuple(table.ravel().tolist()))
+    rest = values[3 * numFull:]
+    if len(rest):
+        text += (' %5d %5d' % (row + 1, col + 1 + 3 * numFull) +
+                 ' %21.14e' * len(rest) % tuple(rest.tolist()) + '\n')
+    return text
+
+
+def time_conversion(snxFile, workDir, outOfCore=False):
+    """Convert a SINEX file with the stages of createBLs.py timed separately
+
+    Returns a dictionary of the seconds taken by each stage. Out of core the
+    baseline columns are formed as they are written, so they are formed once
+    on their own to time the deltas and that time is taken off the emit time
+    """
+    seconds = {}
+    timings = {}
+    start = time.perf_counter()
+    epoch, data, vcv = createBLs.read_sinex(snxFile, outOfCore,
+                                            timings=timings)
+    read = time.perf_counter() - start
+    seconds['parse'] = read - timings['assemble']
+    seconds['assemble'] = timings['assemble']
+
+    start = time.perf_counter()
+    coords = createBLs.station_coords(data)
+    if outOfCore:
+        deltas = createBLs.coordinate_deltas(coords)
+        for column in createBLs.packed_baseline_columns(vcv, 3 * len(data)):
+            pass
+    else:
+        deltas, delVCV = createBLs.baseline_deltas(coords, vcv)
+    seconds['deltas'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if outOfCore:
+        columns = createBLs.packed_baseline_columns(vcv, 3 * len(data))
+    else:
+        columns = (delVCV[3 * i:, 3 * i:3 * i + 3]
+                   for i in range(len(data) - 1))
+    stnFile = os.path.join(workDir, 'benchmark_stn.xml')
+    msrFile = os.path.join(workDir, 'benchmark_msr.xml')
+    with open(stnFile, 'w', buffering=createBLs.writeBuffer) as stn:
+        stn.write(createBLs.dynaml_header('Station File', 'ITRF2014', epoch))
+        createBLs.write_stations(stn, data)
+        stn.write('</DnaXmlFormat>\n')
+    with open(msrFile, 'w', buffering=createBLs.writeBuffer) as msr:
+        msr.write(createBLs.dynaml_header('Measurement File', 'ITRF2014',
+                                          epoch))
+        createBLs.write_cluster(msr, 'ITRF2014', epoch,
+                                [d['site'] for d in data], deltas, columns,
+                                os.path.basename(snxFile))
+        msr.write('</DnaXmlFormat>\n')
+    seconds['emit'] = time.perf_counter() - start
+    if outOfCore:
+        seconds['emit'] -= seconds['deltas']
+    seconds['total'] = sum(seconds.values())
+
+    outputBytes = os.path.getsize(stnFile) + os.path.getsize(msrFile)
+    os.remove(stnFile)
+    os.remove(msrFile)
+    return seconds, outputBytes
+
+
+def run_benchmark(numStations, form, triangle, workDir, outOfCore, repeat):
+    """Time the conversion of a synthetic SINEX file, generating the file
+    first if it does not exist
+
+    Returns the result for the station count, keeping the fastest of repeat
+    runs of each stage
+    """
+    snxFile = synth_name(workDir, numStations, form, triangle)
+    if not os.path.exists(snxFile):
+        synth_sinex(snxFile, numStations, form, triangle)
+    best = None
+    for _ in range(repeat):
+        seconds, outputBytes = time_conversion(snxFile, workDir, outOfCore)
+        if best is None:
+            best = seconds
+        else:
+            best = {stage: min(best[stage], seconds[stage])
+                    for stage in best}
+    peakMemory = None
+    if resource is not None:
+        peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peakMemory *= 1024
+    return {'stations': numStations,
+            'parameters': 3 * numStations,
+            'sinexBytes': os.path.getsize(snxFile),
+            'outputBytes': outputBytes,
+            'seconds': best,
+            'peakMemoryBytes': peakMemory}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time createBLs.py on synthetic SINEX files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', metavar='N', dest='stations', type=int,
+                        nargs='+', default=[10, 100, 1000, 5000],
+                        help='The station counts to time')
+    parser.add_argument('--form', choices=['COVA', 'CORR', 'INFO'],
+                        default='COVA',
+                        help='The form of the synthetic matrices')
+    parser.add_argument('--triangle', choices=['L', 'U'], default='L',
+                        help='The triangle of the synthetic matrices')
+    parser.add_argument('--out-of-core', dest='outOfCore',
+                        action='store_true',
+                        help='Time the out-of-core conversion')
+    parser.add_argument('--repeat', metavar='R', type=int, default=1,
+                        help='Keep the fastest of R runs of each stage')
+    parser.add_argument('--workdir', metavar='DIR', dest='workDir',
+                        default='benchmark',
+                        help='The directory for the synthetic SINEX files')
+    parser.add_argument('--report', metavar='FILE',
+                        default='createBLs_benchmark.json',
+                        help='The JSON report to write')
+    parser.add_argument('--generate', action='store_true',
+                        help='Only write the synthetic SINEX files')
+    args = parser.parse_args()
+
+    os.makedirs(args.workDir, exist_ok=True)
+    if args.generate:
+        for numStations in args.stations:
+            snxFile = synth_name(args.workDir, numStations, args.form,
+                                 args.triangle)
+            synth_sinex(snxFile, numStations, args.form, args.triangle)
+            print(snxFile)
+        return
+
+    results = []
+    for numStations in args.stations:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_benchmark, numStations, args.form,
+                                 args.triangle, args.workDir, args.outOfCore,
+                                 args.repeat).result()
+        results.append(result)
+        print('%6d stations: %s' % (numStations, '  '.join(
+            '%s %.3f s' % stage for stage in result['seconds'].items())))
+
+    report = {'benchmark': 'createBLs.py',
+              'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'settings': {'form': args.form,
+                           'triangle': args.triangle,
+                           'outOfCore': args.outOfCore,
+                           'repeat': args.repeat},
+              'results': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
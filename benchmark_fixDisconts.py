@@ -0,0 +1,612 @@
+#!/usr/bin/env python3
+
+"""
+NAME:
+    benchmark_fixDisconts.py
+PURPOSE:
+    Time fixDisconts_v0.3.py on synthetic NGCA DynaML files, and check its
+    output against golden digests
+EXPLANATION:
+    Synthetic DynaML station and measurement files are generated for each
+    measurement count, with a matching apref_YYDOY.disconts file. The
+    measurement types are drawn from the type mix given, e.g. G:2,X:1,S:4, and
+    the given shares of the measurements are ignored or have no epoch. A
+    share of the stations are APREF stations with discontinuities.
+
+    Each count is fixed by fixDisconts_v0.3.py in a fresh process on a fresh
+    copy of the synthetic files, and the measurement blocks fixed per second
+    and the peak memory of the process are reported. The results are written
+    as a JSON report
+
+    With --check, small synthetic files are fixed serially, with -j 2, and
+    with CRLF line endings in the station file, and the SHA-256 digests of
+    the output files are compared with the golden digests in
+    fixDisconts_golden.json. --record takes the golden digests from the
+    original fixDisconts_v0.3.py, as first committed, with only the intended
+    differences of goldenDifferences patched in, and checks that the current
+    script gives the same output before writing them
+USAGE:
+    benchmark_fixDisconts.py [-n N [N...]] [--mix MIX] [--ignored SHARE]
+        [--epochless SHARE] [--stations S] [--jobs J] [--repeat R]
+        [--workdir DIR] [--report FILE] [--generate] [--check | --record]
+INPUT:
+    None. The synthetic files are written to the work directory and are
+    reused by later runs with the same settings
+OUTPUT:
+    A JSON report, by default fixDisconts_benchmark.json. With --generate the
+    synthetic files are written and nothing is timed. With --check the cases
+    that do not match their golden digests are listed and the exit status is 1
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+
+fixScript = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'fixDisconts_v0.3.py')
+goldenFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fixDisconts_golden.json')
+
+# The root and the discontinuity file of the synthetic files, the share of
+# the stations that are APREF stations, and the number of measurements
+# written at a time by the generator
+synthRoot = 'synth'
+synthDisconts = 'apref_20123.disconts'
+aprefShare = 0.2
+synthBatch = 10000
+
+# The measurement types of DynaML other than G, X, Y and D, by the number of
+# stations they are between
+singleTypes = 'HIJPQR'
+pairTypes = 'BCEKLMSVZ'
+tripleTypes = 'A'
+
+# The settings of the golden cases, as (measurements, mix, ignored share,
+# epoch-less share, stations, seed)
+goldenCases = [
+    (2000, 'G:1,X:1,Y:1,D:1,S:1,L:1,H:1,M:1', 0.1, 0.15, 60, 1),
+    (2000, 'G:4,X:2,S:1', 0.3, 0.4, 30, 2),
+    (2000, 'D:2,S:2,L:1,H:1,A:1,R:1', 0.05, 0.05, 100, 3),
+]
+
+# The intended differences of the golden output from that of the original
+# fixDisconts script, and the edits to the original that make them. The
+# original wrote the station variants in set order, which changes from run to
+# run, so without the edits its station file has no stable digest
+goldenDifferences = [
+    'Ignored measurements are written once, not twice',
+    'Stations are renamed in Third elements as well as First, Second and '
+    'Target elements',
+    'The variants of a renamed station are written in order of their names',
+    'A renamed station is repeated under its own new names only, not under '
+    'every new name that contains its name',
+]
+originalEdits = [
+    [("            for line in msrBlock:\n"
+      "                mf.write(line + '\\n')\n"
+      "            break\n",
+      "            fix = epochSet = False\n"
+      "            break\n")],
+    [("if 'Target' in data:",
+      "if 'Target' in data or 'Third' in data:"),
+     ("name = data.replace('<Target>', '')",
+      "name = data.replace('<Target>', '').replace('<Third>', '')"),
+     ("name = name.replace('</Target>', '')",
+      "name = name.replace('</Target>', '').replace('</Third>', '')")],
+    [('for newName in addStn:', 'for newName in sorted(addStn):')],
+    [('if name in newName:', "if newName.rpartition('_')[0] == name:")],
+]
+
+
+def parse_mix(mix):
+    """Returns the types and weights of a type mix such as G:2,X:1,S:4"""
+    types = []
+    weights = []
+    for item in mix.split(','):
+        msrType, _, weight = item.partition(':')
+        msrType = msrType.strip().upper()
+        if (len(msrType) != 1 or
+                msrType not in 'GXYD' + singleTypes + pairTypes +
+                              tripleTypes):
+            raise ValueError('Unknown measurement type in mix: ' + item)
+        types.append(msrType)
+        weights.append(float(weight) if weight else 1.0)
+    return types, weights
+
+
+def synth_dir(workDir, numMsrs, mix, ignored, epochless, numStations, seed):
+    """Returns the directory of the synthetic files for the settings"""
+    settings = '%s %s %s %s' % (mix, ignored, epochless, seed)
+    digest = hashlib.sha1(settings.encode()).hexdigest()[:8]
+    return os.path.join(workDir, 'synth_%08d_%05d_%s' %
+                        (numMsrs, numStations, digest))
+
+
+def synth_site(i):
+    """Returns the name of synthetic station i. The first four characters
+    are unique, as APREF station names are
+    """
+    return '%s%03d' % (chr(65 + i // 1000 % 26), i % 1000) + 'ABCD'[i % 4:]
+
+
+def synth_epoch(rng, epochless):
+    """Returns a random DD.MM.YYYY epoch between 1995 and 2020, or None for
+    the share epochless of measurements. Some of the epochs are not valid
+    dates, as in real NGCA files
+    """
+    r = rng.random()
+    if r < epochless:
+        return None
+    if r < epochless + 0.01:
+        return '31.02.%04d' % rng.randint(1995, 2020)
+    return '%02d.%02d.%04d' % (rng.randint(1, 28), rng.randint(1, 12),
+                               rng.randint(1995, 2020))
+
+
+def synth_disconts(fileName, sites, rng):
+    """Write an APREF discontinuity file with one to four discontinuities
+    for each of sites, and return the sites
+    """
+    with open(fileName, 'w') as f:
+        f.write('* Synthetic APREF discontinuities\n'
+                '*SITE_YYYYDOY  SOLN\n')
+        for site in sites:
+            for k in range(rng.randint(1, 4)):
+                f.write('%s_%04d%03d  %d\n' %
+                        (site[:4], rng.randint(1995, 2020),
+                         rng.randint(1, 365), k + 1))
+    return sites
+
+
+def synth_station(name):
+    """Returns the text of a DnaStation element"""
+    return ('\t<DnaStation>\n'
+            '\t\t<Name>%s</Name>\n'
+            '\t\t<Constraints>FFF</Constraints>\n'
+            '\t\t<Type>LLH</Type>\n'
+            '\t\t<StationCoord>\n'
+            '\t\t\t<Name>%s</Name>\n'
+            '\t\t\t<XAxis>-35.0000000</XAxis>\n'
+            '\t\t\t<YAxis>149.0000000</YAxis>\n'
+            '\t\t\t<Height>600.000</Height>\n'
+            '\t\t</StationCoord>\n'
+            '\t\t<Description>Synthetic station %s</Description>\n'
+            '\t</DnaStation>\n' % (name, name, name))
+
+
+def synth_baseline(first, second, rng):
+    """Returns the elements of a GPS baseline between first and second"""
+    return ('\t\t<First>%s</First>\n'
+            '\t\t<Second>%s</Second>\n'
+            '\t\t<GPSBaseline>\n'
+            '\t\t\t<X>%.4f</X>\n'
+            '\t\t\t<Y>%.4f</Y>\n'
+            '\t\t\t<Z>%.4f</Z>\n'
+            '\t\t\t<SigmaXX>1.0e-05</SigmaXX>\n'
+            '\t\t\t<SigmaXY>1.0e-07</SigmaXY>\n'
+            '\t\t\t<SigmaXZ>1.0e-07</SigmaXZ>\n'
+            '\t\t\t<SigmaYY>1.0e-05</SigmaYY>\n'
+            '\t\t\t<SigmaYZ>1.0e-07</SigmaYZ>\n'
+            '\t\t\t<SigmaZZ>1.0e-05</SigmaZZ>\n'
+            '\t\t</GPSBaseline>\n' %
+            (first, second, rng.uniform(-1e5, 1e5), rng.uniform(-1e5, 1e5),
+             rng.uniform(-1e5, 1e5)))
+
+
+def synth_measurement(msrType, stations, ignored, epochless, rng):
+    """Returns the text of a DnaMeasurement element of type msrType between
+    random stations, including the comment DynaML files put before it
+    """
+    text = ('\t<!--Type %s-->\n'
+            '\t<DnaMeasurement>\n'
+            '\t\t<Type>%s</Type>\n' % (msrType, msrType))
+    text += ('\t\t<Ignore>*</Ignore>\n' if rng.random() < ignored else
+             '\t\t<Ignore/>\n')
+    epoch = synth_epoch(rng, epochless)
+    if msrType in 'GXY':
+        text += '\t\t<ReferenceFrame>GDA2020</ReferenceFrame>\n'
+    if epoch:
+        text += '\t\t<Epoch>%s</Epoch>\n' % epoch
+    if msrType == 'G':
+        text += ('\t\t<Vscale>1.000</Vscale>\n' +
+                 synth_baseline(*rng.sample(stations, 2), rng=rng))
+    elif msrType == 'X':
+        cluster = rng.sample(stations, rng.randint(2, 4))
+        text += ('\t\t<Vscale>1.000</Vscale>\n'
+                 '\t\t<Total>%d</Total>\n' % (len(cluster) - 1))
+        for second in cluster[1:]:
+            text += synth_baseline(cluster[0], second, rng)
+    elif msrType == 'Y':
+        cluster = rng.sample(stations, rng.randint(1, 3))
+        text += ('\t\t<Coords>XYZ</Coords>\n'
+                 '\t\t<Total>%d</Total>\n' % len(cluster))
+        for first in cluster:
+            text += ('\t\t<First>%s</First>\n'
+                     '\t\t<Clusterpoint>\n'
+                     '\t\t\t<X>-4500000.0000</X>\n'
+                     '\t\t\t<Y>2600000.0000</Y>\n'
+                     '\t\t\t<Z>-3600000.0000</Z>\n'
+                     '\t\t\t<SigmaXX>1.0e-05</SigmaXX>\n'
+                     '\t\t\t<SigmaYY>1.0e-05</SigmaYY>\n'
+                     '\t\t\t<SigmaZZ>1.0e-05</SigmaZZ>\n'
+                     '\t\t</Clusterpoint>\n' % first)
+    elif msrType == 'D':
+        first, second, *targets = rng.sample(stations, rng.randint(3, 5))
+        text += ('\t\t<First>%s</First>\n'
+                 '\t\t<Second>%s</Second>\n'
+                 '\t\t<Value>%.4f</Value>\n'
+                 '\t\t<StdDev>1.0</StdDev>\n'
+                 '\t\t<Total>%d</Total>\n' %
+                 (first, second, rng.uniform(0, 360), len(targets)))
+        for target in targets:
+            text += ('\t\t<Directions>\n'
+                     '\t\t\t<Ignore/>\n'
+                     '\t\t\t<Target>%s</Target>\n'
+                     '\t\t\t<Value>%.4f</Value>\n'
+                     '\t\t\t<StdDev>1.0</StdDev>\n'
+                     '\t\t</Directions>\n' % (target, rng.uniform(0, 360)))
+    elif msrType in tripleTypes:
+        text += ('\t\t<First>%s</First>\n'
+                 '\t\t<Second>%s</Second>\n'
+                 '\t\t<Third>%s</Third>\n'
+                 '\t\t<Value>%.4f</Value>\n'
+                 '\t\t<StdDev>1.0</StdDev>\n' %
+                 (*rng.sample(stations, 3), rng.uniform(0, 360)))
+    elif msrType in pairTypes:
+        text += ('\t\t<First>%s</First>\n'
+                 '\t\t<Second>%s</Second>\n'
+                 '\t\t<Value>%.4f</Value>\n'
+                 '\t\t<StdDev>0.0100</StdDev>\n' %
+                 (*rng.sample(stations, 2), rng.uniform(1, 1e4)))
+    else:
+        text += ('\t\t<First>%s</First>\n'
+                 '\t\t<Value>%.4f</Value>\n'
+                 '\t\t<StdDev>0.0100</StdDev>\n' %
+                 (rng.choice(stations), rng.uniform(1, 1e3)))
+    return text + '\t</DnaMeasurement>\n'
+
+
+def synth_dynaml(synthDir, numMsrs, mix, ignored=0.1, epochless=0.15,
+                 numStations=500, seed=0):
+    """Write a synthetic pair of DynaML files, <synthRoot>_stn.xml and
+    <synthRoot>_msr.xml, and a matching APREF discontinuity file to synthDir
+
+    The share aprefShare of the numStations stations have discontinuities.
+    The numMsrs measurements are of the types of mix, in proportion to their
+    weights, and are written synthBatch at a time, so memory does not grow
+    with their number
+    """
+    rng = random.Random(seed)
+    types, weights = parse_mix(mix)
+    stations = [synth_site(i) for i in range(numStations)]
+    aprefSites = rng.sample(stations, max(1, int(aprefShare * numStations)))
+    os.makedirs(synthDir, exist_ok=True)
+    synth_disconts(os.path.join(synthDir, synthDisconts), aprefSites, rng)
+
+    # The APREF stations are named by their four character site codes
+    aprefSites = set(aprefSites)
+    stations = [stn[:4] if stn in aprefSites else stn for stn in stations]
+    header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              '<DnaXmlFormat type="%s File" referenceframe="GDA2020" '
+              'epoch="01.01.2020" xmlns:xsi="http://www.w3.org/2001/'
+              'XMLSchema-instance" xsi:noNamespaceSchemaLocation='
+              '"DynaML.xsd">\n')
+    with open(os.path.join(synthDir, synthRoot + '_stn.xml'), 'w') as f:
+        f.write(header % 'Station')
+        for name in stations:
+            f.write(synth_station(name))
+        f.write('</DnaXmlFormat>\n')
+    with open(os.path.join(synthDir, synthRoot + '_msr.xml'), 'w') as f:
+        f.write(header % 'Measurement')
+        for start in range(0, numMsrs, synthBatch):
+            batch = rng.choices(types, weights,
+                                k=min(synthBatch, numMsrs - start))
+            f.write(''.join(synth_measurement(msrType, stations, ignored,
+                                              epochless, rng)
+                            for msrType in batch))
+        f.write('</DnaXmlFormat>\n')
+
+
+def crlf_copy(synthDir, crlfDir):
+    """Copy the synthetic files in synthDir to crlfDir, with CRLF line
+    endings in the station file
+    """
+    shutil.rmtree(crlfDir, ignore_errors=True)
+    shutil.copytree(synthDir, crlfDir)
+    stnFile = os.path.join(crlfDir, synthRoot + '_stn.xml')
+    with open(stnFile, 'rb') as f:
+        data = f.read()
+    with open(stnFile, 'wb') as f:
+        f.write(data.replace(b'\n', b'\r\n'))
+
+
+def fresh_copy(synthDir, runDir):
+    """Copy the synthetic files in synthDir to an empty runDir"""
+    shutil.rmtree(runDir, ignore_errors=True)
+    os.makedirs(runDir)
+    for fileName in (synthRoot + '_stn.xml', synthRoot + '_msr.xml',
+                     synthDisconts):
+        shutil.copyfile(os.path.join(synthDir, fileName),
+                        os.path.join(runDir, fileName))
+
+
+def original_script(fileName):
+    """Write the original fixDisconts_v0.3.py, as first committed, to
+    fileName, with the edits of originalEdits that make the intended
+    differences of goldenDifferences
+
+    Returns the commit the original was taken from
+    """
+    repoDir = os.path.dirname(fixScript)
+    scriptName = os.path.basename(fixScript)
+    commit = subprocess.run(['git', 'log', '--diff-filter=A', '--format=%H',
+                             '--', scriptName], cwd=repoDir, check=True,
+                            capture_output=True, text=True).stdout.split()
+    if not commit:
+        raise RuntimeError('There is no commit adding ' + scriptName)
+    commit = commit[-1]
+    source = subprocess.run(['git', 'show', '%s:%s' % (commit, scriptName)],
+                            cwd=repoDir, check=True, capture_output=True,
+                            text=True).stdout
+    for difference, edits in zip(goldenDifferences, originalEdits):
+        for old, new in edits:
+            if old not in source:
+                raise RuntimeError('The original %s cannot be edited so that '
+                                   '%s' % (scriptName, difference.lower()))
+            source = source.replace(old, new)
+    with open(fileName, 'w') as f:
+        f.write(source)
+    return commit
+
+
+def run_original(synthDir, runDir, originalFile):
+    """Fix a fresh copy of the synthetic files in synthDir in runDir with
+    the edited original script originalFile, which finds the discontinuity
+    file in the working directory
+    """
+    fresh_copy(synthDir, runDir)
+    command = [sys.executable, originalFile, synthRoot]
+    proc = subprocess.run(command, cwd=runDir, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, text=True)
+    if proc.returncode:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(command),
+                                               proc.stdout))
+
+
+def run_fix(synthDir, runDir, jobs=1):
+    """Fix a fresh copy of the synthetic files in synthDir in runDir with
+    fixDisconts_v0.3.py in a separate process
+
+    Returns the seconds taken to fix the files, as reported by
+    fixDisconts_v0.3.py, and the peak memory in bytes of the largest process
+    it ran, or None where that cannot be found
+    """
+    fresh_copy(synthDir, runDir)
+    # The output goes to a file rather than a pipe, so the process can be
+    # waited on with wait4 to find its peak memory
+    command = [sys.executable, fixScript, '--disconts', synthDisconts,
+               '-j', str(jobs), synthRoot]
+    with open(os.path.join(runDir, 'fix.log'), 'w+') as log:
+        proc = subprocess.Popen(command, cwd=runDir, stdout=log,
+                                stderr=subprocess.STDOUT)
+        peakMemory = None
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peakMemory = usage.ru_maxrss
+            if sys.platform != 'darwin':
+                peakMemory *= 1024
+        else:
+            proc.wait()
+        log.seek(0)
+        out = log.read()
+    match = re.search(r'in ([0-9.]+) s$', out.strip())
+    if proc.returncode or not match:
+        raise RuntimeError('%s failed:\n%s' % (' '.join(command), out))
+    return float(match.group(1)), peakMemory
+
+
+def output_digests(runDir):
+    """Returns the SHA-256 digests of the fixed files in runDir"""
+    digests = {}
+    for fileName in (synthRoot + '_stn.xml', synthRoot + '_msr.xml'):
+        sha = hashlib.sha256()
+        with open(os.path.join(runDir, fileName), 'rb') as f:
+            for data in iter(lambda: f.read(1 << 20), b''):
+                sha.update(data)
+        digests[fileName] = sha.hexdigest()
+    return digests
+
+
+def run_benchmark(numMsrs, args):
+    """Time fixDisconts_v0.3.py on the synthetic files for numMsrs
+    measurements, generating the files first if they do not exist
+
+    Returns the result for the measurement count, keeping the fastest of
+    args.repeat runs
+    """
+    synthDir = synth_dir(args.workDir, numMsrs, args.mix, args.ignored,
+                         args.epochless, args.stations, args.seed)
+    if not os.path.exists(os.path.join(synthDir, synthRoot + '_msr.xml')):
+        synth_dynaml(synthDir, numMsrs, args.mix, args.ignored,
+                     args.epochless, args.stations, args.seed)
+    runDir = os.path.join(args.workDir, 'run')
+    seconds = []
+    peakMemory = None
+    for _ in range(args.repeat):
+        runSeconds, runMemory = run_fix(synthDir, runDir, args.jobs)
+        seconds.append(runSeconds)
+        if runMemory is not None:
+            peakMemory = max(peakMemory or 0, runMemory)
+    msrBytes = os.path.getsize(os.path.join(synthDir,
+                                            synthRoot + '_msr.xml'))
+    shutil.rmtree(runDir)
+    best = min(seconds)
+    return {'measurements': numMsrs,
+            'msrBytes': msrBytes,
+            'seconds': best,
+            'blocksPerSecond': numMsrs / best if best else None,
+            'peakMemoryBytes': peakMemory}
+
+
+def check_golden(workDir, record=False):
+    """Fix the golden cases serially, with -j 2 and with a CRLF station file,
+    and compare the digests of the output files with the golden digests. The
+    CRLF station file is streamed rather than rewritten from its byte-offset
+    index, and must give the same output
+
+    With record, the golden digests are taken from the output of the edited
+    original script instead, and written if all the cases match them
+
+    Returns the names of the cases that do not match
+    """
+    golden = {}
+    if record:
+        originalFile = os.path.join(workDir, 'fixDisconts_original.py')
+        commit = original_script(originalFile)
+    else:
+        with open(goldenFile) as f:
+            golden = json.load(f)['cases']
+    failures = []
+    for numMsrs, mix, ignored, epochless, numStations, seed in goldenCases:
+        name = '%d %s %s %s %d %d' % (numMsrs, mix, ignored, epochless,
+                                      numStations, seed)
+        synthDir = os.path.join(workDir, 'golden_%d' % seed)
+        synth_dynaml(synthDir, numMsrs, mix, ignored, epochless,
+                     numStations, seed)
+        crlfDir = synthDir + '_crlf'
+        crlf_copy(synthDir, crlfDir)
+        if record:
+            runDir = os.path.join(workDir, 'run')
+            run_original(synthDir, runDir, originalFile)
+            golden[name] = output_digests(runDir)
+            shutil.rmtree(runDir)
+        for runSynthDir, jobs, label in ((synthDir, 1, '-j 1'),
+                                         (synthDir, 2, '-j 2'),
+                                         (crlfDir, 1, 'CRLF stations')):
+            runDir = os.path.join(workDir, 'run')
+            run_fix(runSynthDir, runDir, jobs)
+            digests = output_digests(runDir)
+            shutil.rmtree(runDir)
+            if golden.get(name) != digests:
+                failures.append('%s (%s)' % (name, label))
+        shutil.rmtree(synthDir)
+        shutil.rmtree(crlfDir)
+    if record:
+        os.remove(originalFile)
+    if record and not failures:
+        with open(goldenFile, 'w') as f:
+            json.dump({'script': os.path.basename(fixScript),
+                       'created': datetime.datetime.now().isoformat(
+                           timespec='seconds'),
+                       'description': 'The output of the original script, '
+                                      'as first committed, with only the '
+                                      'intended differences made',
+                       'original': commit,
+                       'differencesFromOriginal': goldenDifferences,
+                       'cases': golden}, f, indent=2)
+            f.write('\n')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time fixDisconts_v0.3.py on synthetic DynaML files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', metavar='N', dest='measurements', type=int,
+                        nargs='+', default=[10**4, 10**5, 10**6, 10**7],
+                        help='The measurement counts to time. The files for '
+                        '10^7 measurements take about 4 GB with the default '
+                        'mix')
+    parser.add_argument('--mix', default='G:1,X:1,Y:1,D:1,S:1,L:1,H:1',
+                        help='The measurement types and their weights')
+    parser.add_argument('--ignored', metavar='SHARE', type=float,
+                        default=0.1,
+                        help='The share of the measurements that are ignored')
+    parser.add_argument('--epochless', metavar='SHARE', type=float,
+                        default=0.15,
+                        help='The share of the measurements without an epoch')
+    parser.add_argument('--stations', metavar='S', type=int, default=500,
+                        help='The number of stations')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed of the synthetic files')
+    parser.add_argument('--jobs', metavar='J', type=int, default=1,
+                        help='Run fixDisconts_v0.3.py with -j J')
+    parser.add_argument('--repeat', metavar='R', type=int, default=1,
+                        help='Keep the fastest of R runs')
+    parser.add_argument('--workdir', metavar='DIR', dest='workDir',
+                        default='benchmark',
+                        help='The directory for the synthetic files')
+    parser.add_argument('--report', metavar='FILE',
+                        default='fixDisconts_benchmark.json',
+                        help='The JSON report to write')
+    parser.add_argument('--generate', action='store_true',
+                        help='Only write the synthetic files')
+    golden = parser.add_mutually_exclusive_group()
+    golden.add_argument('--check', action='store_true',
+                        help='Check the output against the golden digests')
+    golden.add_argument('--record', action='store_true',
+                        help='Record the golden digests')
+    args = parser.parse_args()
+
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    os.makedirs(args.workDir, exist_ok=True)
+    if args.check or args.record:
+        failures = check_golden(args.workDir, args.record)
+        if failures:
+            print('%d golden cases do not match:' % len(failures),
+                  file=sys.stderr)
+            for name in failures:
+                print('    ' + name, file=sys.stderr)
+            sys.exit(1)
+        print('Recorded' if args.record else 'Checked',
+              '%d golden cases' % len(goldenCases))
+        return
+    if args.generate:
+        for numMsrs in args.measurements:
+            synthDir = synth_dir(args.workDir, numMsrs, args.mix,
+                                 args.ignored, args.epochless, args.stations,
+                                 args.seed)
+            synth_dynaml(synthDir, numMsrs, args.mix, args.ignored,
+                         args.epochless, args.stations, args.seed)
+            print(synthDir)
+        return
+
+    results = []
+    for numMsrs in args.measurements:
+        result = run_benchmark(numMsrs, args)
+        results.append(result)
+        print('%9d measurements: %.2f s  %.0f blocks/s  peak %s' %
+              (numMsrs, result['seconds'], result['blocksPerSecond'] or 0,
+               '%.1f MB' % (result['peakMemoryBytes'] / 1e6)
+               if result['peakMemoryBytes'] else 'unknown'))
+
+    report = {'benchmark': 'fixDisconts_v0.3.py',
+              'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'settings': {'mix': args.mix,
+                           'ignored': args.ignored,
+                           'epochless': args.epochless,
+                           'stations': args.stations,
+                           'seed': args.seed,
+                           'jobs': args.jobs,
+                           'repeat': args.repeat},
+              'results': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
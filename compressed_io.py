@@ -0,0 +1,74 @@
+"""
+Reading and writing text files that may be compressed, shared by
+createBLs.py, fixDisconts_v0.3.py and DynAdjust_TypeB.py
+
+Compressed files are recognised from their magic numbers rather than their
+names. gzip and xz files are read and written with the standard library, and
+Unix compress (.Z) files are read by piping them through gzip
+"""
+import gzip
+import io
+import lzma
+import signal
+import subprocess
+
+
+# Magic numbers of the compressed file formats that can be read
+compressedMagic = {b'\x1f\x8b': 'gz', b'\x1f\x9d': 'Z',
+                   b'\xfd7zXZ\x00': 'xz'}
+
+
+class PipedFile(io.TextIOWrapper):
+    """Text stream of the output of a decompression process, which is waited
+    on when the stream is closed
+    """
+    def __init__(self, process):
+        super().__init__(process.stdout)
+        self.process = process
+
+    def close(self):
+        super().close()
+
+        # A process still writing when the stream is closed before it has
+        # all been read is killed by SIGPIPE, which is not a failure
+        returnCode = self.process.wait()
+        if returnCode != 0 and returnCode != -getattr(signal, 'SIGPIPE', 0):
+            raise OSError('Decompression of %s failed' % self.process.args[-1])
+
+
+def compression_of(fileName):
+    """Returns the compression of a file found from its magic number, i.e.,
+    'gz', 'Z', 'xz', or None if it is not compressed
+    """
+    with open(fileName, 'rb') as f:
+        head = f.read(6)
+    for magic, compression in compressedMagic.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_file(fileName, mode='r', compression=None, buffering=-1):
+    """Open a text file that may be compressed
+
+    Files opened for reading are decompressed as they are read if they are
+    gzip, Unix compress (.Z) or xz compressed, whatever their names. Unix
+    compressed files are piped through gzip. Files opened for writing are
+    compressed if compression is 'gz' or 'xz', at the fastest level
+    """
+    if 'r' in mode:
+        compression = compression_of(fileName)
+        if compression == 'gz':
+            return gzip.open(fileName, 'rt')
+        if compression == 'xz':
+            return lzma.open(fileName, 'rt')
+        if compression == 'Z':
+            return PipedFile(subprocess.Popen(['gzip', '-dc', fileName],
+                                              stdout=subprocess.PIPE))
+    elif compression == 'gz':
+        return gzip.open(fileName, mode + 't', compresslevel=1)
+    elif compression == 'xz':
+        return lzma.open(fileName, mode + 't', preset=0)
+    elif compression is not None:
+        raise ValueError('Cannot write %s compressed files' % compression)
+    return open(fileName, mode, buffering=buffering)
@@ -11,13 +11,20 @@ EXPLANATION:
     both a DynaML formatted station and measurement file for input into
     DynAdjust
 USAGE:
-    createBLs.py infile [infile...]
+    createBLs.py [-j N] infile [infile...]
 INPUT:
-    One or more SINEX files. Wildcards may be used 
+    One or more SINEX files, which may be gzip, Unix compress (.Z) or xz
+    compressed. Wildcards may be used. With -j/--jobs N the files
+    are converted by a pool of N processes, and any files that could not be
+    converted are reported together at the end of the run
 OUTPUT:
     One DynaML formatted station file and one DynaML formatted measurement file
     per input SINEX file. These files will have _stn.xml and _msr.xml appended
-    to the root of the infile
+    to the root of the infile, followed by .gz or .xz with --compress. With
+    --merge NAME all the SINEX files go into NAME_stn.xml, holding each
+    station once, and NAME_msr.xml, holding a cluster per SINEX file. With
+    --max-cluster N the baselines are split into clusters of at most N
+    stations, grouped by position or by correlation (--partition)
 HISTORY:
     0.01    2013-05-30  Craig Harrison
             - Written
@@ -62,206 +69,1082 @@ HISTORY:
             - Generalised for inclusion in datum-modernisation repo
 """
 import argparse
+import hashlib
+import math
 import os
+import sys
 import datetime
-import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from compressed_io import open_file
 
 
-# Set up argparse
-refFrames = ['GDA94', 'GDA2020', 'ITRF2014', 'ITRF2008', 'ITRF2005',
-             'ITRF2000', 'ITRF97', 'ITRF96', 'ITRF94', 'ITRF93', 'ITRF92',
-             'ITRF91', 'ITRF90', 'ITRF89', 'ITRF88', 'WGS84']
-parser = argparse.ArgumentParser(
-    description='Convert a SINEX file into a DynaML GNSS baseline cluster',
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('-r', metavar='reference frame', dest='refFrame', type=str,
-                    default='ITRF2014', choices=refFrames,
-                    help='The reference frame of the SINEX file')
-parser.add_argument('files', nargs='+',
-                    help='The SINEX file to be converted')
-parser.add_argument('--version', action='version', version='%(prog)s 3.00')
-args = parser.parse_args()
-
-# Loop over the input files
-for inputFile in args.files:
-
-    # Get root name of the SINEX file and open the output files
-    rootName = os.path.basename(inputFile)
-    rootName = rootName.split('.')[0]
-    stn = open(rootName + '_stn.xml', 'w')
-    msr = open(rootName + '_msr.xml', 'w')
+def sinex_blocks(snxFile, blockNames):
+    """Stream the data lines of the named SINEX blocks in a single pass
+
+    Yields (header, line) for every data line inside one of the blocks in
+    blockNames, where header is the split block header, e.g.
+    ('SOLUTION/MATRIX_ESTIMATE', 'L', 'COVA'). Comment lines and the lines of
+    all other blocks are skipped without being stored
+    """
+    header = None
+    for line in snxFile:
+        first = line[:1]
+        if first == '+':
+            header = tuple(line[1:].split())
+            if not header or header[0] not in blockNames:
+                header = None
+        elif first == '-':
+            header = None
+        elif header is not None and first != '*' and first != '%':
+            yield header, line
+
+
+def matrix_elements(lines):
+    """Parse lines of a SINEX matrix block into index and value arrays
+
+    Returns the zero-based row and column indices and the value of every
+    element given on the lines. The text is converted in one call and the
+    number of elements on each line is found from the starts of its fields,
+    so there is no per-element Python work
+    """
+    text = ''.join(lines)
+    flat = np.fromstring(text, sep=' ')
+    chars = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+    blank = chars <= 32
+    starts = ~blank
+    starts[1:] &= blank[:-1]
+    lineOfField = np.searchsorted(np.flatnonzero(chars == 10),
+                                  np.flatnonzero(starts))
+    counts = np.bincount(lineOfField, minlength=len(lines))[:len(lines)]
+    if counts.sum() != len(flat) or counts.min() < 3:
+        raise ValueError('Malformed SINEX matrix line')
+
+    # Each line is PARA1 PARA2 followed by the values of row PARA1 from
+    # column PARA2 onwards
+    offsets = np.cumsum(counts) - counts
+    rows = flat[offsets].astype(np.int64) - 1
+    cols = flat[offsets + 1].astype(np.int64) - 1
+    lineOf = np.repeat(np.arange(len(lines)), counts - 2)
+    position = np.arange(len(flat)) - np.repeat(offsets, counts)
+    isValue = position >= 2
+    return rows[lineOf], cols[lineOf] + position[isValue] - 2, flat[isValue]
+
+
+def sinex_vcv(vcv, matrixType):
+    """Convert a symmetric SINEX matrix of the given type to a VCV matrix
+
+    The matrix is either dense or its packed upper triangle. COVA matrices are
+    returned unchanged. CORR matrices hold the standard deviations on the
+    diagonal and the correlations elsewhere and are scaled in place. INFO
+    matrices hold the normal equations and are inverted, which needs the
+    dense matrix
+    """
+    if matrixType == 'COVA':
+        return vcv
+    if matrixType == 'CORR':
+        if vcv.ndim == 1:
+            size = packed_size(vcv)
+            sd = vcv[packed_index(np.arange(size), np.arange(size), size)]
+            for i in range(size):
+                row = packed_row(vcv, size, i)
+                row *= sd[i] * sd[i:]
+                row[0] = sd[i]**2
+            return vcv
+        sd = np.diag(vcv).copy()
+        for i in range(len(sd)):
+            vcv[i] *= sd[i] * sd
+        np.fill_diagonal(vcv, sd**2)
+        return vcv
+    if matrixType == 'INFO':
+        if vcv.ndim == 1:
+            raise ValueError('INFO matrices cannot be inverted out of core')
+        return np.linalg.inv(vcv)
+    raise ValueError('Unknown SINEX matrix type ' + matrixType)
+
+
+def packed_size(vcv):
+    """Returns the order of the matrix held as the packed triangle vcv"""
+    return (math.isqrt(8 * len(vcv) + 1) - 1) // 2
+
+
+def allocate_vcv(size, packed=False, scratch=None):
+    """Returns a zeroed size x size VCV matrix, or its packed upper triangle,
+    which is memory-mapped to a temporary file in the scratch directory if
+    one is given
+    """
+    if not packed:
+        return np.zeros((size, size))
+    length = size * (size + 1) // 2
+    if scratch is None:
+        return np.zeros(length)
+    return np.memmap(tempfile.TemporaryFile(dir=scratch), dtype=np.float64,
+                     mode='w+', shape=(length,))
+
+
+def scatter_elements(vcv, rows, cols, values):
+    """Write matrix elements into both triangles of a dense VCV matrix, or
+    into the packed upper triangle
+    """
+    if vcv.ndim == 1:
+        vcv[packed_index(rows, cols, packed_size(vcv))] = values
+    else:
+        vcv[rows, cols] = values
+        vcv[cols, rows] = values
+
+
+def station_coords(data):
+    """Returns the 3n x 1 matrix of observed antenna positions"""
+    coords = np.array(np.zeros((3 * len(data), 1)))
+    for i in range(len(data)):
+        coords[3 * i, 0] = data[i]['x']
+        coords[3 * i + 1, 0] = data[i]['y']
+        coords[3 * i + 2, 0] = data[i]['z']
+    return coords
+
+
+def coordinate_deltas(coords):
+    """Returns the 3(n-1) x 1 matrix of the deltas from the first station to
+    every other station
+    """
+    numBaselines = len(coords) // 3 - 1
+    return (coords[3:].reshape(numBaselines, 3) -
+            coords[:3].reshape(1, 3)).reshape(3 * numBaselines, 1)
+
+
+def baseline_deltas(coords, vcv):
+    """Form the baselines from the first station to every other station
+
+    Returns the 3(n-1) x 1 matrix of deltas and their 3(n-1) x 3(n-1) VCV
+    matrix, i.e., the same values as D @ coords and D @ vcv @ D.T for the
+    design matrix D, but taken directly as differences of 3x3 blocks of vcv in
+    O(n^2) time and without forming D
+    """
+    numBaselines = len(coords) // 3 - 1
+    deltas = coordinate_deltas(coords)
+
+    # delVCV_ij = (vcv_ij - vcv_0j) - (vcv_i0 - vcv_00) with the blocks
+    # indexed by station. The subtractions are done in the same order as the
+    # matrix products, so the results are identical
+    delVCV = np.empty((3 * numBaselines, 3 * numBaselines))
+    blocks = delVCV.reshape(numBaselines, 3, numBaselines, 3)
+    np.subtract(vcv[3:, 3:].reshape(numBaselines, 3, numBaselines, 3),
+                vcv[:3, 3:].reshape(1, 3, numBaselines, 3), out=blocks)
+    blocks -= (vcv[3:, :3].reshape(numBaselines, 3, 3) -
+               vcv[:3, :3]).reshape(numBaselines, 3, 1, 3)
+    return deltas, delVCV
+
+
+def packed_index(rows, cols, size):
+    """Returns the positions of the elements of a symmetric size x size matrix
+    in its upper triangle packed row by row
+    """
+    low = np.minimum(rows, cols)
+    high = np.maximum(rows, cols)
+    return low * (2 * size - low - 1) // 2 + high
+
+
+def packed_row(vcv, size, row):
+    """Returns a view of the elements of row of a packed upper triangle from
+    the diagonal onwards
+    """
+    start = row * (2 * size - row - 1) // 2 + row
+    return vcv[start:start + size - row]
+
+
+def packed_strip(vcv, size, row):
+    """Returns the three rows of a symmetric matrix starting at row, from
+    column row onwards, taken from its packed upper triangle
+    """
+    strip = np.empty((3, size - row))
+    for i in range(3):
+        strip[i, i:] = packed_row(vcv, size, row + i)
+    strip[1, 0] = strip[0, 1]
+    strip[2, 0] = strip[0, 2]
+    strip[2, 1] = strip[1, 2]
+    return strip
+
+
+def packed_baseline_columns(vcv, size):
+    """Yield the columns of the baseline VCV matrix, one baseline at a time,
+    from the packed upper triangle of the station VCV matrix
+
+    The columns are the same as delVCV[3 * i:, 3 * i:3 * i + 3] from
+    baseline_deltas, but delVCV is never formed. Only whole rows of the
+    packed triangle are read, so a memory-mapped triangle is read in order
+    """
+    origin = packed_strip(vcv, size, 0)
+    vcv00 = origin[:, :3]
+    for row in range(3, size, 3):
+        strip = packed_strip(vcv, size, row)
+        vcv0s = origin[:, row:]
+        numBlocks = strip.shape[1] // 3
+        column = ((strip.T.reshape(numBlocks, 3, 3) - vcv0s[:, :3]) -
+                  (vcv0s.T.reshape(numBlocks, 3, 3) - vcv00))
+        yield column.reshape(3 * numBlocks, 3)
+
+
+def station_params(stations):
+    """Returns the rows of the VCV matrix belonging to the stations"""
+    stations = np.asarray(stations, dtype=np.int64)
+    return (3 * stations[:, np.newaxis] + np.arange(3)).ravel()
+
+
+def station_vcv(vcv, stations, size=None):
+    """Returns the VCV matrix of the stations, taken from the full VCV matrix
+    or, if size is given, from its packed upper triangle
+    """
+    params = station_params(stations)
+    if size is None:
+        return vcv[np.ix_(params, params)]
+    return np.asarray(vcv[packed_index(params[:, np.newaxis], params, size)])
+
+
+# Number of the most strongly correlated stations kept for each station when
+# the stations are grouped by connectivity
+connectivityNeighbours = 64
+
+
+def station_correlations(vcv, numStations, packed=False):
+    """Returns the summed absolute correlations between the coordinates of
+    each pair of stations as a sparse, symmetric graph, keeping the
+    connectivityNeighbours strongest correlations of each station
+
+    The graph is a tuple of the correlation of each station with itself, the
+    offsets of the edges of each station, and the stations and correlations
+    the edges lead to. It is built three rows of vcv at a time, so a
+    memory-mapped packed triangle is read in order, and its memory grows
+    with the number of stations rather than its square
+    """
+    size = 3 * numStations
+    if packed:
+        sd = np.sqrt(np.array([packed_row(vcv, size, i)[0]
+                               for i in range(size)]))
+    else:
+        sd = np.sqrt(np.diagonal(vcv))
+
+    # The strongest edges found so far of each station are kept in a buffer
+    # of twice the number kept, which is cut back to the strongest when full.
+    # Only edges stronger than the weakest kept are added to a buffer
+    numKept = max(1, min(connectivityNeighbours, numStations - 1))
+    bufStations = np.zeros((numStations, 2 * numKept), dtype=np.int64)
+    bufStrengths = np.full((numStations, 2 * numKept), -np.inf)
+    counts = np.zeros(numStations, dtype=np.int64)
+    floor = np.full(numStations, -np.inf)
+    selfStrength = np.empty(numStations)
+
+    def keep_strongest(stations):
+        """Cut the buffers of the stations back to their strongest edges"""
+        order = np.argsort(-bufStrengths[stations], axis=1,
+                           kind='stable')[:, :numKept]
+        kept = np.take_along_axis(bufStrengths[stations], order, axis=1)
+        bufStations[stations, :numKept] = np.take_along_axis(
+            bufStations[stations], order, axis=1)
+        bufStrengths[stations, :numKept] = kept
+        bufStrengths[stations, numKept:] = -np.inf
+        counts[stations] = np.minimum(counts[stations], numKept)
+        floor[stations] = kept[:, -1]
+
+    for i in range(numStations):
+        row = 3 * i
+        if packed:
+            strip = packed_strip(vcv, size, row)
+        else:
+            strip = vcv[row:row + 3, row:]
+        corr = np.abs(strip / sd[row:row + 3, np.newaxis] / sd[row:])
+        strength = corr.reshape(3, numStations - i, 3).sum(axis=(0, 2))
+        selfStrength[i] = strength[0]
+        later = strength[1:]
+
+        # Add the edges to the later stations to their buffers, and the
+        # strongest of them to the buffer of station i, which is then final
+        take = np.flatnonzero(later > floor[i + 1:])
+        stations = take + i + 1
+        position = counts[stations]
+        bufStations[stations, position] = i
+        bufStrengths[stations, position] = later[take]
+        counts[stations] += 1
+        full = stations[counts[stations] == 2 * numKept]
+        if len(full):
+            keep_strongest(full)
+        keep_strongest([i])
+        if len(later) > numKept:
+            take = np.argpartition(later, -numKept)[-numKept:]
+        else:
+            take = np.arange(len(later))
+        position = counts[i] + np.arange(len(take))
+        bufStations[i, position] = take + i + 1
+        bufStrengths[i, position] = later[take]
+        counts[i] += len(take)
+        keep_strongest([i])
+
+    # Join the edges kept by either of their stations, once each, and list
+    # them from both of their stations
+    first = np.repeat(np.arange(numStations), numKept)
+    second = bufStations[:, :numKept].ravel()
+    strengths = bufStrengths[:, :numKept].ravel()
+    isEdge = np.isfinite(strengths)
+    first, second, strengths = first[isEdge], second[isEdge], strengths[isEdge]
+    low = np.minimum(first, second)
+    high = np.maximum(first, second)
+    _, unique = np.unique(low * numStations + high, return_index=True)
+    low, high, strengths = low[unique], high[unique], strengths[unique]
+    first = np.concatenate((low, high))
+    order = np.argsort(first, kind='stable')
+    neighbours = np.concatenate((high, low))[order]
+    strengths = np.concatenate((strengths, strengths))[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(
+        first, minlength=numStations))))
+    return selfStrength, offsets, neighbours, strengths
+
+
+def add_correlations(score, graph, station):
+    """Add the summed absolute correlations of a station with each station,
+    from the graph of station_correlations, to score
+    """
+    selfStrength, offsets, neighbours, strengths = graph
+    score[station] += selfStrength[station]
+    edges = slice(offsets[station], offsets[station + 1])
+    score[neighbours[edges]] += strengths[edges]
+
+
+def spatial_partition(xyz, stations, maxSize):
+    """Returns the stations split into groups of at most maxSize stations by
+    recursive coordinate bisection
+
+    The stations are split along the coordinate with the largest extent, in
+    proportion to the number of groups needed on each side, so the groups are
+    compact, close to the same size, and neighbouring groups follow on from
+    one another
+    """
+    numGroups = -(-len(stations) // maxSize)
+    if numGroups == 1:
+        return [stations]
+    points = xyz[stations]
+    axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+    order = stations[np.argsort(points[:, axis], kind='stable')]
+    split = len(order) * (numGroups // 2) // numGroups
+    return (spatial_partition(xyz, order[:split], maxSize) +
+            spatial_partition(xyz, order[split:], maxSize))
+
+
+def connectivity_partition(graph, maxSize):
+    """Returns the stations split into groups of at most maxSize stations by
+    their correlations, given as the graph of station_correlations
+
+    Each group is grown from the first station not yet in a group by adding,
+    one at a time, the station most strongly correlated with the group so far
+    """
+    numStations = len(graph[0])
+    free = np.ones(numStations, dtype=bool)
+    groups = []
+    while free.any():
+        seed = np.flatnonzero(free)[0]
+        free[seed] = False
+        group = [seed]
+        score = np.zeros(numStations)
+        add_correlations(score, graph, seed)
+        while len(group) < maxSize and free.any():
+            station = np.argmax(np.where(free, score, -np.inf))
+            free[station] = False
+            group.append(station)
+            add_correlations(score, graph, station)
+        groups.append(np.array(group))
+    return groups
+
+
+def baseline_clusters(coords, vcv, maxSize, strategy='spatial', packed=False):
+    """Returns the stations of each baseline cluster when a solution is split
+    into clusters of at most maxSize stations
+
+    The first station of each cluster is the one the baselines are formed
+    from. For every cluster after the first this is a station of an earlier
+    cluster (the one nearest the centre of the cluster, or the one most
+    strongly correlated with it), which ties the clusters together into one
+    network. Correlations are kept within each cluster and dropped between
+    clusters
+    """
+    numStations = len(coords) // 3
+    if numStations <= maxSize:
+        return [np.arange(numStations)]
+    xyz = coords.reshape(numStations, 3)
+    if strategy == 'connectivity':
+        graph = station_correlations(vcv, numStations, packed)
+        groups = connectivity_partition(graph, maxSize - 1)
+    else:
+        groups = spatial_partition(xyz, np.arange(numStations), maxSize - 1)
+
+    clusters = []
+    for k, group in enumerate(groups):
+        if k == 0:
+            candidates = group
+        else:
+            candidates = np.concatenate(groups[:k])
+        if strategy == 'connectivity':
+            score = np.zeros(numStations)
+            for station in group:
+                add_correlations(score, graph, station)
+            link = np.argmax(score[candidates])
+        else:
+            centre = xyz[group].mean(axis=0)
+            link = np.argmin(np.linalg.norm(xyz[candidates] - centre, axis=1))
+        first = candidates[link]
+        cluster = np.concatenate(([first], group[group != first]))
+        if len(cluster) > 1:
+            clusters.append(cluster)
+    return clusters
+
+
+# Number of matrix lines parsed at a time
+matrixChunk = 65536
+
 
-    # Open the SINEX file and read in all lines
-    snxFile = open(inputFile)
-    lines = snxFile.readlines()
+def sinex_parameters(inputFile):
+    """Returns the number of estimated parameters given in the header line of
+    a SINEX file, or None if there is no valid header line
+    """
+    with open_file(inputFile) as snxFile:
+        col = snxFile.readline().split()
+    if len(col) > 8 and col[0] == '%=SNX' and col[8].isdigit():
+        return int(col[8])
+    return None
 
-    # Create lists to hold the site ID, station coordinate estimate, and the
-    # VCV matrix lines
-    estimateLines = []
+
+def memory_estimate(numParams, outOfCore=False, scratch=None):
+    """Returns the estimated peak memory in bytes needed to convert a solution
+    with numParams parameters
+
+    The dense path holds the VCV matrix and the baseline VCV matrix. Out of
+    core, the packed triangle is held in memory, or on disk with a scratch
+    directory, and only one baseline column is formed at a time
+    """
+    working = matrixChunk * 768 + numParams * 3 * 8 * 4
+    if not outOfCore:
+        return working + 8 * (numParams**2 + (numParams - 3)**2)
+    if scratch is None:
+        return working + 8 * numParams * (numParams + 1) // 2
+    return working
+
+
+def subset_elements(elements, subset):
+    """Returns the matrix elements whose row and column both belong to the
+    subset, renumbered to the rows of the subset. subset maps each row of the
+    full matrix to its row in the subset, or -1 if it is not in the subset
+    """
+    rows, cols, values = elements
+    rows = subset[rows]
+    cols = subset[cols]
+    keep = (rows >= 0) & (cols >= 0)
+    return rows[keep], cols[keep], values[keep]
+
+
+def read_sinex(inputFile, packed=False, scratch=None, timings=None,
+               stations=None):
+    """Read the station coordinate estimates and their VCV matrix from a
+    SINEX file
+
+    Returns the epoch of the solution (DD.MM.YYYY), a list of dictionaries
+    holding the site ID and coordinates of each station, and the 3n x 3n VCV
+    matrix. If packed is set the VCV matrix is returned as its packed upper
+    triangle, memory-mapped to a file in the scratch directory if one is
+    given. If a timings dictionary is given, the seconds spent assembling the
+    VCV matrix from the parsed elements are stored in it under 'assemble'.
+
+    If a set of site IDs is given in stations, only those stations are kept.
+    Matrix lines of other stations are skipped before they are parsed, and
+    only the VCV matrix of the kept stations is built. INFO matrices must be
+    inverted whole, so for them the full matrix is built and the kept rows and
+    columns are taken from its inverse
+    """
+    # Stream the SINEX file once. The site IDs and station coordinate
+    # estimates are parsed as they are read, and the lines of the matrix are
+    # parsed in chunks and scattered into vcv by symmetry, so it does not
+    # matter whether the SINEX file gives the lower or upper triangle.
+    # SOLUTION/ESTIMATE precedes SOLUTION/MATRIX_ESTIMATE in a SINEX file, so
+    # the size of the matrix is known by its first chunk. For a subset of the
+    # stations, subset maps the rows of the full matrix to those of the subset
+    data = []
+    selected = []
+    subset = None
+    matrixSize = None
+    refEpoch = None
+    numEstimates = 0
+    vcv = None
+    matrixType = 'COVA'
     matrixLines = []
-    goE = 0
-    goM = 0
-    for line in lines:
-        if re.match('\+SOLUTION/ESTIMATE', line):
-            goE = 1
-        if re.match('\+SOLUTION/MATRIX_ESTIMATE', line):
-            goM = 1
-        if goE and not re.match('[+*-]', line):
-            estimateLines.append(line)
-        if goM and not re.match('[+*-]', line):
+    assembly = 0.0
+    with open_file(inputFile) as snxFile:
+        for header, line in sinex_blocks(snxFile, ('SOLUTION/ESTIMATE',
+                                                   'SOLUTION/MATRIX_ESTIMATE')):
+            if header[0] == 'SOLUTION/ESTIMATE':
+                col = line.split()
+                if refEpoch is None:
+                    refEpoch = line[27:33]
+                if numEstimates % 3 == 0:
+                    source = {}
+                    source['site'] = col[2].upper()
+                    source['x'] = float(col[8])
+                    if stations is None or source['site'] in stations:
+                        data.append(source)
+                        selected.append(numEstimates // 3)
+                elif numEstimates % 3 == 1:
+                    source['y'] = float(col[8])
+                else:
+                    source['z'] = float(col[8])
+                numEstimates += 1
+                continue
+            if len(header) > 2:
+                matrixType = header[2].upper()
+            if matrixSize is None:
+                matrixSize = numEstimates
+                if stations is not None and matrixType != 'INFO':
+                    subset = np.full(numEstimates, -1)
+                    subset[station_params(selected)] = np.arange(3 * len(data))
+                    matrixSize = 3 * len(data)
+            if subset is not None and subset[int(line[:6]) - 1] < 0:
+                continue
             matrixLines.append(line)
-        if re.match('-SOLUTION/ESTIMATE', line):
-            goE = 0
-        if re.match('-SOLUTION/MATRIX_ESTIMATE', line):
-            goM = 0
+            if len(matrixLines) == matrixChunk:
+                elements = matrix_elements(matrixLines)
+                if subset is not None:
+                    elements = subset_elements(elements, subset)
+                start = time.perf_counter()
+                if vcv is None:
+                    vcv = allocate_vcv(matrixSize, packed, scratch)
+                scatter_elements(vcv, *elements)
+                assembly += time.perf_counter() - start
+                matrixLines = []
+    if not data:
+        if numEstimates:
+            raise ValueError('None of the stations are in ' + inputFile)
+        raise ValueError('No SOLUTION/ESTIMATE block in ' + inputFile)
+    elements = matrix_elements(matrixLines) if matrixLines else None
+    if elements is not None and subset is not None:
+        elements = subset_elements(elements, subset)
+    start = time.perf_counter()
+    if vcv is None:
+        vcv = allocate_vcv(matrixSize or 3 * len(data), packed, scratch)
+    if elements is not None:
+        scatter_elements(vcv, *elements)
+    vcv = sinex_vcv(vcv, matrixType)
+    if matrixSize is not None and matrixSize != 3 * len(data):
+        vcv = station_vcv(vcv, selected)
+    if timings is not None:
+        timings['assemble'] = assembly + time.perf_counter() - start
 
     # Get the yearDoy and epoch
-    year = int(estimateLines[0][27:29])
+    year = int(refEpoch[0:2])
     if year < 94:
         year += 2000
     else:
         year += 1900
-    doy = int(estimateLines[0][30:33])
+    doy = int(refEpoch[3:6])
     date = datetime.date(year, 1, 1)
     date = date + datetime.timedelta(days=doy)
     epoch = date.strftime('%d.%m.%Y')
+    return epoch, data, vcv
 
-    # Write headers
-    stn.write('<?xml version="1.0"?>\n')
-    stn.write('<DnaXmlFormat type="Station File" referenceframe="' +
-              args.refFrame + '" epoch="' + epoch +
-              '" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' +
-              'xsi:noNamespaceSchemaLocation="DynaML.xsd">\n')
-
-    msr.write('<?xml version="1.0"?>\n')
-    msr.write('<DnaXmlFormat type="Measurement File" referenceframe="' +
-              args.refFrame + '" epoch="' + epoch +
-              '" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' +
-              'xsi:noNamespaceSchemaLocation="DynaML.xsd">\n')
-
-    # Create a list of dictionaries to hold the station names and their
-    # coordinates
-    stats = []
-    data = []
-    estimateLines.reverse()
-    while estimateLines:
-        col = estimateLines.pop().rstrip().split()
-        source = {}
-        stats.append(col[2].upper())
-        source['site'] = col[2].upper()
-        source['x'] = float(col[8])
-        col = estimateLines.pop().rstrip().split()
-        source['y'] = float(col[8])
-        col = estimateLines.pop().rstrip().split()
-        source['z'] = float(col[8])
-        data.append(source)
-
-    # Create the variance-covariance matrix. In the SINEX file it is given as
-    # a lower triangular matrix
-    vcvL = np.array(np.zeros((3 * len(data), 3 * len(data))))
-    for line in matrixLines:
-        col = line.rstrip().split()
-        for i in range(2, len(col)):
-            vcvL[int(col[0]) - 1, int(col[1]) + i - 3] = float(col[i])
-    vcvU = np.copy(vcvL.transpose())
-    for i in range(3 * len(data)):
-        vcvU[i, i] = 0
-    vcv = vcvL + vcvU
-
-    # Create the design matrix
-    desMatrix = np.array(np.zeros((3 * (len(data) - 1), 3 * len(data))))
-    for i in range(len(data) - 1):
-        desMatrix[3 * i, 0] = -1
-        desMatrix[3 * i + 1, 1] = -1
-        desMatrix[3 * i + 2, 2] = -1
-        desMatrix[3 * i, 3 * (i + 1)] = 1
-        desMatrix[3 * i + 1, 3 * (i + 1) + 1] = 1
-        desMatrix[3 * i + 2, 3 * (i + 1) + 2] = 1
 
-    # Create the matrix of observed antenna positions
-    coords = np.array(np.zeros((3 * len(data), 1)))
-    for i in range(len(data)):
-        coords[3 * i, 0] = data[i]['x']
-        coords[3 * i + 1, 0] = data[i]['y']
-        coords[3 * i + 2, 0] = data[i]['z']
+# Version of the layout of the cached solutions. Changing it invalidates
+# every cache entry
+cacheVersion = 1
 
-    # Calculate the deltas and the corresponding VCV matrix
-    deltas = desMatrix @ coords
-    delVCV = desMatrix @ vcv @ desMatrix.transpose()
 
-    # Loop over the sites and write the station data to the output XML file
-    for i in range(len(data)):
-        stn.write('\t<DnaStation>\n')
-        stn.write('\t\t<Name>%s</Name>\n' % (data[i]['site']))
-        stn.write('\t\t<Constraints>FFF</Constraints>\n')
-        stn.write('\t\t<Type>XYZ</Type>\n')
-        stn.write('\t\t<StationCoord>\n')
-        stn.write('\t\t\t<Name>%s</Name>\n' % (data[i]['site']))
-        stn.write('\t\t\t<XAxis>%20.14e</XAxis>\n' % (data[i]['x']))
-        stn.write('\t\t\t<YAxis>%20.14e</YAxis>\n' % (data[i]['y']))
-        stn.write('\t\t\t<Height>%20.14e</Height>\n' % (data[i]['z']))
-        stn.write('\t\t\t<HemisphereZone></HemisphereZone>\n')
-        stn.write('\t\t</StationCoord>\n')
-        stn.write('\t\t<Description></Description>\n')
-        stn.write('\t</DnaStation>\n')
-
-    # Write the measurement data to the output XML file
+def cache_key(inputFile, packed=False, stations=None):
+    """Returns the cache key of a SINEX file, formed from a hash of its
+    contents and the settings it is parsed with
+    """
+    digest = hashlib.sha256()
+    with open(inputFile, 'rb') as snxFile:
+        for chunk in iter(lambda: snxFile.read(1 << 20), b''):
+            digest.update(chunk)
+    settings = 'v%d-%s' % (cacheVersion, 'packed' if packed else 'dense')
+    if stations is not None:
+        subset = hashlib.sha256(' '.join(sorted(stations)).encode('ascii'))
+        settings += '-' + subset.hexdigest()[:16]
+    return digest.hexdigest() + '-' + settings
+
+
+def load_cached_sinex(cacheDir, key, mmap=False):
+    """Returns the cached epoch, station data and VCV matrix of a solution,
+    or None if it is not in the cache. The VCV matrix is memory-mapped
+    read-only from the cache if mmap is set
+    """
+    path = os.path.join(cacheDir, key)
+    try:
+        with np.load(path + '.npz') as stations:
+            epoch = str(stations['epoch'])
+            sites = stations['sites'].tolist()
+            xyz = stations['xyz'].tolist()
+        vcv = np.load(path + '.npy', mmap_mode='r' if mmap else None)
+
+        # Mark the entry as recently used. An entry evicted by another run
+        # since it was read is a cache miss
+        os.utime(path + '.npy')
+    except (OSError, KeyError, ValueError):
+        return None
+    data = [{'site': site, 'x': x, 'y': y, 'z': z}
+            for site, (x, y, z) in zip(sites, xyz)]
+    return epoch, data, vcv
+
+
+def store_cached_sinex(cacheDir, key, epoch, data, vcv):
+    """Add a parsed solution to the cache. The files are written under
+    temporary names and renamed, so concurrent runs never see partial entries
+    """
+    os.makedirs(cacheDir, exist_ok=True)
+    path = os.path.join(cacheDir, key)
+    suffix = '.%d.tmp' % os.getpid()
+    with open(path + '.npz' + suffix, 'wb') as stations:
+        np.savez(stations, epoch=np.array(epoch),
+                 sites=np.array([d['site'] for d in data]),
+                 xyz=np.array([[d['x'], d['y'], d['z']] for d in data]))
+    with open(path + '.npy' + suffix, 'wb') as matrix:
+        np.save(matrix, vcv)
+    os.replace(path + '.npz' + suffix, path + '.npz')
+    os.replace(path + '.npy' + suffix, path + '.npy')
+
+
+def evict_cache(cacheDir, maxBytes):
+    """Remove the least recently used entries from the cache until it holds
+    no more than maxBytes
+    """
+    entries = []
+    for name in os.listdir(cacheDir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cacheDir, name[:-4])
+        try:
+            size = (os.path.getsize(path + '.npy') +
+                    os.path.getsize(path + '.npz'))
+            entries.append((os.path.getmtime(path + '.npy'), size, path))
+        except OSError:
+            continue
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        for ext in ('.npy', '.npz'):
+            try:
+                os.remove(path + ext)
+            except OSError:
+                pass
+        total -= size
+
+
+def read_sinex_cached(inputFile, cacheDir, cacheSize, packed=False,
+                      scratch=None, stations=None):
+    """Read a SINEX file as read_sinex does, but through a cache of parsed
+    solutions in cacheDir capped at cacheSize bytes
+
+    On a hit the text is not parsed at all. Out of core with a scratch
+    directory, the cached VCV matrix is memory-mapped instead of read in
+    """
+    key = cache_key(inputFile, packed, stations)
+    cached = load_cached_sinex(cacheDir, key, packed and scratch is not None)
+    if cached is not None:
+        return cached
+    epoch, data, vcv = read_sinex(inputFile, packed, scratch,
+                                  stations=stations)
+    store_cached_sinex(cacheDir, key, epoch, data, vcv)
+    evict_cache(cacheDir, cacheSize)
+    return epoch, data, vcv
+
+
+# Size of the write buffer of the output files, and the number of
+# GPSCovariance elements formatted at a time
+writeBuffer = 1 << 20
+covarianceChunk = 4096
+
+# DynaML templates for a station, for a baseline of a Type X cluster up to
+# its covariances, and for one covariance between two of its baselines
+stationXml = ('\t<DnaStation>\n'
+              '\t\t<Name>%s</Name>\n'
+              '\t\t<Constraints>FFF</Constraints>\n'
+              '\t\t<Type>XYZ</Type>\n'
+              '\t\t<StationCoord>\n'
+              '\t\t\t<Name>%s</Name>\n'
+              '\t\t\t<XAxis>%20.14e</XAxis>\n'
+              '\t\t\t<YAxis>%20.14e</YAxis>\n'
+              '\t\t\t<Height>%20.14e</Height>\n'
+              '\t\t\t<HemisphereZone></HemisphereZone>\n'
+              '\t\t</StationCoord>\n'
+              '\t\t<Description></Description>\n'
+              '\t</DnaStation>\n')
+baselineXml = ('\t\t<First>%s</First>\n'
+               '\t\t<Second>%s</Second>\n'
+               '\t\t<GPSBaseline>\n'
+               '\t\t\t<X>%20.14e</X>\n'
+               '\t\t\t<Y>%20.14e</Y>\n'
+               '\t\t\t<Z>%20.14e</Z>\n'
+               '\t\t\t<SigmaXX>%20.14e</SigmaXX>\n'
+               '\t\t\t<SigmaXY>%20.14e</SigmaXY>\n'
+               '\t\t\t<SigmaXZ>%20.14e</SigmaXZ>\n'
+               '\t\t\t<SigmaYY>%20.14e</SigmaYY>\n'
+               '\t\t\t<SigmaYZ>%20.14e</SigmaYZ>\n'
+               '\t\t\t<SigmaZZ>%20.14e</SigmaZZ>\n')
+covarianceXml = ('\t\t\t<GPSCovariance>\n'
+                 '\t\t\t\t<m11>%20.14e</m11>\n'
+                 '\t\t\t\t<m12>%20.14e</m12>\n'
+                 '\t\t\t\t<m13>%20.14e</m13>\n'
+                 '\t\t\t\t<m21>%20.14e</m21>\n'
+                 '\t\t\t\t<m22>%20.14e</m22>\n'
+                 '\t\t\t\t<m23>%20.14e</m23>\n'
+                 '\t\t\t\t<m31>%20.14e</m31>\n'
+                 '\t\t\t\t<m32>%20.14e</m32>\n'
+                 '\t\t\t\t<m33>%20.14e</m33>\n'
+                 '\t\t\t</GPSCovariance>\n')
+
+
+def dynaml_header(fileType, refFrame, epoch):
+    """Returns the XML declaration and opening DnaXmlFormat tag of a DynaML
+    file
+    """
+    return ('<?xml version="1.0"?>\n'
+            '<DnaXmlFormat type="' + fileType + '" referenceframe="' +
+            refFrame + '" epoch="' + epoch +
+            '" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' +
+            'xsi:noNamespaceSchemaLocation="DynaML.xsd">\n')
+
+
+def write_stations(stn, data):
+    """Write the station data to a DynaML station file"""
+    for source in data:
+        stn.write(stationXml % (source['site'], source['site'], source['x'],
+                                source['y'], source['z']))
+
+
+def write_baseline(msr, first, second, delta, column):
+    """Write one baseline of a Type X cluster to a DynaML measurement file
+
+    column holds the three columns of the cluster VCV for the baseline from
+    its own rows down, i.e., its 3x3 variance block followed by its 3x3
+    covariance block with each of the later baselines. The covariances are
+    formatted straight from array slices in chunks of covarianceChunk
+    """
+    msr.write(baselineXml % (first, second, delta[0], delta[1], delta[2],
+                             column[0, 0], column[1, 0], column[2, 0],
+                             column[1, 1], column[2, 1], column[2, 2]))
+
+    # The element mAB of a covariance block is in row B and column A
+    covariances = column[3:].reshape(-1, 3, 3).transpose(0, 2, 1)
+    for start in range(0, len(covariances), covarianceChunk):
+        chunk = covariances[start:start + covarianceChunk]
+        msr.write((covarianceXml * len(chunk)) %
+                  tuple(chunk.ravel().tolist()))
+    msr.write('\t\t</GPSBaseline>\n')
+
+
+def write_cluster(msr, refFrame, epoch, sites, deltas, columns, source):
+    """Write a Type X GNSS baseline cluster from the first of the sites to
+    each of the others to a DynaML measurement file
+
+    columns gives the columns of the baseline VCV matrix for each baseline in
+    turn, as taken by write_baseline
+    """
     msr.write('\t<!--Type X GNSS baseline cluster (full correlations)-->\n')
     msr.write('\t<DnaMeasurement>\n')
     msr.write('\t\t<Type>X</Type>\n')
     msr.write('\t\t<Ignore/>\n')
-    msr.write('\t\t<ReferenceFrame>%s</ReferenceFrame>\n' % args.refFrame)
+    msr.write('\t\t<ReferenceFrame>%s</ReferenceFrame>\n' % refFrame)
     msr.write('\t\t<Epoch>%s</Epoch>\n' % epoch)
     msr.write('\t\t<Vscale>1.000</Vscale>\n')
     msr.write('\t\t<Pscale>1.000</Pscale>\n')
     msr.write('\t\t<Lscale>1.000</Lscale>\n')
     msr.write('\t\t<Hscale>1.000</Hscale>\n')
-    msr.write('\t\t<Total>%s</Total>\n' % (len(data) - 1))
-    numCovar = len(data) - 2
-    for i in range(len(data)-1):
-        msr.write('\t\t<First>%s</First>\n' % (data[0]['site']))
-        msr.write('\t\t<Second>%s</Second>\n' % (data[i+1]['site']))
-        msr.write('\t\t<GPSBaseline>\n')
-        msr.write('\t\t\t<X>%20.14e</X>\n' % (deltas[3 * i, 0]))
-        msr.write('\t\t\t<Y>%20.14e</Y>\n' % (deltas[3 * i + 1, 0]))
-        msr.write('\t\t\t<Z>%20.14e</Z>\n' % (deltas[3 * i + 2, 0]))
-        msr.write('\t\t\t<SigmaXX>%20.14e</SigmaXX>\n' %
-                  (delVCV[3 * i, 3 * i]))
-        msr.write('\t\t\t<SigmaXY>%20.14e</SigmaXY>\n' %
-                  (delVCV[3 * i + 1, 3 * i]))
-        msr.write('\t\t\t<SigmaXZ>%20.14e</SigmaXZ>\n' %
-                  (delVCV[3 * i + 2, 3 * i]))
-        msr.write('\t\t\t<SigmaYY>%20.14e</SigmaYY>\n' %
-                  (delVCV[3 * i + 1, 3 * i + 1]))
-        msr.write('\t\t\t<SigmaYZ>%20.14e</SigmaYZ>\n' %
-                  (delVCV[3 * i + 2, 3 * i + 1]))
-        msr.write('\t\t\t<SigmaZZ>%20.14e</SigmaZZ>\n' %
-                  (delVCV[3 * i + 2, 3 * i + 2]))
-        for j in range(numCovar):
-            msr.write('\t\t\t<GPSCovariance>\n')
-            msr.write('\t\t\t\t<m11>%20.14e</m11>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j, 3 * i]))
-            msr.write('\t\t\t\t<m12>%20.14e</m12>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 1, 3 * i]))
-            msr.write('\t\t\t\t<m13>%20.14e</m13>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 2, 3 * i]))
-            msr.write('\t\t\t\t<m21>%20.14e</m21>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j, 3 * i + 1]))
-            msr.write('\t\t\t\t<m22>%20.14e</m22>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 1, 3 * i + 1]))
-            msr.write('\t\t\t\t<m23>%20.14e</m23>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 2, 3 * i + 1]))
-            msr.write('\t\t\t\t<m31>%20.14e</m31>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j, 3 * i + 2]))
-            msr.write('\t\t\t\t<m32>%20.14e</m32>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 1, 3 * i + 2]))
-            msr.write('\t\t\t\t<m33>%20.14e</m33>\n' %
-                      (delVCV[3 * (i + 1) + 3 * j + 2, 3 * i + 2]))
-            msr.write('\t\t\t</GPSCovariance>\n')
-        numCovar -= 1
-        msr.write('\t\t</GPSBaseline>\n')
-    msr.write('\t\t<Source>%s</Source>\n' % os.path.basename(inputFile))
+    msr.write('\t\t<Total>%s</Total>\n' % (len(sites) - 1))
+    for i, column in enumerate(columns):
+        write_baseline(msr, sites[0], sites[i + 1], deltas[3 * i:3 * i + 3, 0],
+                       column)
+    msr.write('\t\t<Source>%s</Source>\n' % source)
     msr.write('\t</DnaMeasurement>\n')
-    stn.write('</DnaXmlFormat>\n')
-    msr.write('</DnaXmlFormat>\n')
+
+
+def load_sinex(inputFile, outOfCore=False, scratch=None, cacheDir=None,
+               cacheSize=0, stations=None):
+    """Read a SINEX file for conversion, through the cache if a cache
+    directory is given, reporting the memory needed in core and out of core,
+    so either mode can be chosen, and any of the stations that are not in
+    the file
+
+    Returns the epoch, station data and VCV matrix as read_sinex does
+    """
+    numParams = sinex_parameters(inputFile)
+    if numParams is not None:
+        inCore = memory_estimate(numParams) / 1e6
+        outCore = memory_estimate(numParams, True, scratch) / 1e6
+        if outOfCore:
+            print('%s: %d parameters, estimated memory %.1f MB '
+                  '(%.1f MB in core)' % (inputFile, numParams, outCore, inCore))
+        else:
+            print('%s: %d parameters, estimated memory %.1f MB '
+                  '(%.1f MB with --out-of-core)' %
+                  (inputFile, numParams, inCore, outCore))
+    if cacheDir is not None:
+        epoch, data, vcv = read_sinex_cached(inputFile, cacheDir, cacheSize,
+                                             outOfCore, scratch, stations)
+    else:
+        epoch, data, vcv = read_sinex(inputFile, outOfCore, scratch,
+                                      stations=stations)
+    if stations is not None and len(data) < len(stations):
+        print('%s: %d of %d stations not found: %s' %
+              (inputFile, len(stations) - len(data), len(stations),
+               ' '.join(sorted(stations - {d['site'] for d in data}))))
+    return epoch, data, vcv
+
+
+def write_solution(msr, refFrame, epoch, data, vcv, source, outOfCore=False,
+                   maxCluster=None, partition='spatial'):
+    """Write the baselines of a solution to a DynaML measurement file as one
+    Type X cluster, or as clusters of at most maxCluster stations grouped by
+    the partition strategy ('spatial' or 'connectivity')
+    """
+    # Create the matrix of observed antenna positions
+    coords = station_coords(data)
+
+    # Split the stations into clusters
+    if maxCluster is not None:
+        clusters = baseline_clusters(coords, vcv, maxCluster, partition,
+                                     outOfCore)
+    else:
+        clusters = [np.arange(len(data))]
+
+    for stations in clusters:
+        # Calculate the deltas and the corresponding VCV matrix. Out of core,
+        # a single cluster is formed one baseline at a time
+        if len(clusters) == 1 and outOfCore:
+            deltas = coordinate_deltas(coords)
+            columns = packed_baseline_columns(vcv, 3 * len(data))
+        else:
+            if len(clusters) == 1:
+                deltas, delVCV = baseline_deltas(coords, vcv)
+            else:
+                deltas, delVCV = baseline_deltas(
+                    coords[station_params(stations)],
+                    station_vcv(vcv, stations,
+                                3 * len(data) if outOfCore else None))
+            columns = (delVCV[3 * i:, 3 * i:3 * i + 3]
+                       for i in range(len(stations) - 1))
+        write_cluster(msr, refFrame, epoch,
+                      [data[i]['site'] for i in stations], deltas, columns,
+                      source)
+
+
+def convert_sinex(inputFile, refFrame, outOfCore=False, scratch=None,
+                  cacheDir=None, cacheSize=0, compression=None,
+                  maxCluster=None, partition='spatial', stations=None):
+    """Convert a SINEX file into a DynaML station file and a DynaML
+    measurement file holding a Type X GNSS baseline cluster
+
+    Out of core, the VCV matrix is kept as its packed upper triangle,
+    memory-mapped to a file in the scratch directory if one is given, and the
+    baseline VCV matrix is formed and written one baseline at a time. If a
+    cache directory is given, parsed solutions are reused from it. The input
+    may be compressed, and the output files are compressed with gzip or xz
+    if compression is 'gz' or 'xz'. If maxCluster is given, solutions with
+    more stations are split into clusters of at most maxCluster stations
+    using the partition strategy ('spatial' or 'connectivity'). If a set of
+    site IDs is given in stations, only the baselines between those stations
+    are formed
+    """
+    epoch, data, vcv = load_sinex(inputFile, outOfCore, scratch, cacheDir,
+                                  cacheSize, stations)
+
+    # Get root name of the SINEX file and write the output files
+    rootName = os.path.basename(inputFile)
+    rootName = rootName.split('.')[0]
+    suffix = '.' + compression if compression else ''
+    with open_file(rootName + '_stn.xml' + suffix, 'w', compression,
+                   writeBuffer) as stn:
+        stn.write(dynaml_header('Station File', refFrame, epoch))
+        write_stations(stn, data)
+        stn.write('</DnaXmlFormat>\n')
+    with open_file(rootName + '_msr.xml' + suffix, 'w', compression,
+                   writeBuffer) as msr:
+        msr.write(dynaml_header('Measurement File', refFrame, epoch))
+        write_solution(msr, refFrame, epoch, data, vcv,
+                       os.path.basename(inputFile), outOfCore, maxCluster,
+                       partition)
+        msr.write('</DnaXmlFormat>\n')
+
+
+def merge_sinex(inputFiles, outputName, refFrame, outOfCore=False,
+                scratch=None, cacheDir=None, cacheSize=0, compression=None,
+                maxCluster=None, partition='spatial', stations=None):
+    """Convert any number of SINEX files into a single DynaML station file
+    and a single DynaML measurement file named from outputName
+
+    The files are read one at a time, so memory does not grow with the number
+    of files. Each station is written once, with the coordinates from the
+    first file it is found in, and a table of the stations written so far,
+    keyed by site ID, holds the file each came from. The clusters of every
+    file are written as their own measurements. The files are headed with
+    the epoch of the first file converted. Returns the station table and a
+    dictionary of the error message of each file that could not be converted
+    """
+    siteIndex = {}
+    errors = {}
+    suffix = '.' + compression if compression else ''
+    stnFile = outputName + '_stn.xml' + suffix
+    msrFile = outputName + '_msr.xml' + suffix
+    stn = None
+    msr = None
+    try:
+        for inputFile in inputFiles:
+            try:
+                epoch, data, vcv = load_sinex(inputFile, outOfCore, scratch,
+                                              cacheDir, cacheSize, stations)
+            except Exception as e:
+                errors[inputFile] = '%s: %s' % (type(e).__name__, e)
+                continue
+            if stn is None:
+                stn = open_file(stnFile, 'w', compression, writeBuffer)
+                stn.write(dynaml_header('Station File', refFrame, epoch))
+                msr = open_file(msrFile, 'w', compression, writeBuffer)
+                msr.write(dynaml_header('Measurement File', refFrame, epoch))
+            source = os.path.basename(inputFile)
+            newStations = []
+            for station in data:
+                if station['site'] not in siteIndex:
+                    siteIndex[station['site']] = source
+                    newStations.append(station)
+            write_stations(stn, newStations)
+            write_solution(msr, refFrame, epoch, data, vcv, source,
+                           outOfCore, maxCluster, partition)
+            del data, vcv
+        if stn is not None:
+            stn.write('</DnaXmlFormat>\n')
+            msr.write('</DnaXmlFormat>\n')
+    finally:
+        if stn is not None:
+            stn.close()
+            msr.close()
+    return siteIndex, errors
+
+
+def try_convert_sinex(inputFile, refFrame, **options):
+    """Convert a SINEX file, returning an error message rather than raising
+    if the conversion fails
+    """
+    try:
+        convert_sinex(inputFile, refFrame, **options)
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e)
+    return None
+
+
+def main():
+    # Set up argparse
+    refFrames = ['GDA94', 'GDA2020', 'ITRF2014', 'ITRF2008', 'ITRF2005',
+                 'ITRF2000', 'ITRF97', 'ITRF96', 'ITRF94', 'ITRF93', 'ITRF92',
+                 'ITRF91', 'ITRF90', 'ITRF89', 'ITRF88', 'WGS84']
+    parser = argparse.ArgumentParser(
+        description='Convert a SINEX file into a DynaML GNSS baseline cluster',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', metavar='reference frame', dest='refFrame',
+                        type=str, default='ITRF2014', choices=refFrames,
+                        help='The reference frame of the SINEX file')
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int,
+                        default=1,
+                        help='The number of SINEX files converted in '
+                        'parallel, without --merge')
+    parser.add_argument('--out-of-core', dest='outOfCore',
+                        action='store_true',
+                        help='Keep the VCV matrix as a packed triangle and '
+                        'write the baselines one at a time')
+    parser.add_argument('--scratch', metavar='DIR', dest='scratch',
+                        help='Memory-map the out-of-core VCV matrix to a '
+                        'file in this directory on local disk')
+    parser.add_argument('--cache', metavar='DIR', dest='cacheDir',
+                        help='Reuse parsed SINEX solutions cached in this '
+                        'directory')
+    parser.add_argument('--cache-size', metavar='MB', dest='cacheSize',
+                        type=float, default=10240,
+                        help='The size the cache is trimmed to, dropping the '
+                        'least recently used solutions first')
+    parser.add_argument('--compress', dest='compression',
+                        choices=['gz', 'xz'],
+                        help='Compress the output files with gzip or xz')
+    parser.add_argument('--max-cluster', metavar='N', dest='maxCluster',
+                        type=int,
+                        help='Split solutions into baseline clusters of at '
+                        'most N stations')
+    parser.add_argument('--partition', choices=['spatial', 'connectivity'],
+                        default='spatial',
+                        help='Group the stations of each cluster by '
+                        'position or by correlation')
+    parser.add_argument('--stations', metavar='SITES',
+                        help='Only form baselines between these stations, '
+                        'given as a comma separated list of site IDs')
+    parser.add_argument('--stations-file', metavar='FILE',
+                        dest='stationsFile',
+                        help='Only form baselines between the stations '
+                        'listed in this file, separated by whitespace')
+    parser.add_argument('--merge', metavar='NAME', dest='mergeName',
+                        help='Merge all the SINEX files into NAME_stn.xml '
+                        'and NAME_msr.xml, one file at a time')
+    parser.add_argument('files', nargs='+',
+                        help='The SINEX file to be converted')
+    parser.add_argument('--version', action='version',
+                        version='%(prog)s 3.00')
+    args = parser.parse_args()
+    if args.maxCluster is not None and args.maxCluster < 2:
+        parser.error('--max-cluster must be at least 2')
+    if args.mergeName and args.jobs > 1:
+        parser.error('--merge reads the SINEX files one at a time and cannot '
+                     'be used with -j')
+    stations = None
+    if args.stations or args.stationsFile:
+        stations = set(site.upper() for site in (args.stations or '').split(',')
+                       if site)
+        if args.stationsFile:
+            with open(args.stationsFile) as f:
+                stations.update(site.upper() for site in f.read().split())
+    options = {'outOfCore': args.outOfCore or args.scratch is not None,
+               'scratch': args.scratch,
+               'cacheDir': args.cacheDir,
+               'cacheSize': int(args.cacheSize * 1e6),
+               'compression': args.compression,
+               'maxCluster': args.maxCluster,
+               'partition': args.partition,
+               'stations': stations}
+
+    # Convert the input files, one after another or spread over a pool of N
+    # processes, or merge them. Each process holds one solution at a time.
+    # Failures are collected per file and reported once all the files have
+    # been tried
+    errors = {}
+    if args.mergeName:
+        siteIndex, errors = merge_sinex(args.files, args.mergeName,
+                                        args.refFrame, **options)
+        print('%d stations from %d SINEX files merged into %s' %
+              (len(siteIndex), len(args.files) - len(errors), args.mergeName))
+    elif args.jobs > 1 and len(args.files) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(try_convert_sinex, inputFile,
+                                   args.refFrame, **options): inputFile
+                       for inputFile in args.files}
+            for future in as_completed(futures):
+                error = future.result()
+                if error:
+                    errors[futures[future]] = error
+    else:
+        for inputFile in args.files:
+            error = try_convert_sinex(inputFile, args.refFrame, **options)
+            if error:
+                errors[inputFile] = error
+
+    if errors:
+        print('%d of %d SINEX files could not be converted:' %
+              (len(errors), len(args.files)), file=sys.stderr)
+        for inputFile in args.files:
+            if inputFile in errors:
+                print('    %s - %s' % (inputFile, errors[inputFile]),
+                      file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
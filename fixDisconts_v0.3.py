@@ -6,16 +6,26 @@ have a discontinuity in their time series. Ignored measurements are left ignored
 and Type G or X measurements that don't have an epoch are set to ignored.
 
 To call:
-            fixDisconts.py <root>
+            fixDisconts.py [--disconts FILE] [--compress {gz,xz}] [-j N]
+                <root> [<root>...]
 
 where <root> is the root of the input files. That is, the input files will be
-<root>_stn.xml and <root>_msr.xml
+<root>_stn.xml and <root>_msr.xml, either of which may instead be gzip, Unix
+compress or xz compressed and named <root>_stn.xml.gz, .Z or .xz. Any number
+of roots may be given, and the time taken and the stations renamed are
+reported for each
 
-The original files will be copied to *.bak and the output files will have the
-same name as the input files. 
+The original files will be moved to *.bak once both output files have been
+written, and the output files will have the same name as the input files.
+Compressed gzip and xz input files are written
+back with the same compression, and --compress writes the output files with
+gzip or xz compression and the matching extension. With -j N the roots are
+fixed on N processes, or, for a single root, an uncompressed measurement file
+is split into chunks that are fixed on N processes
 
-The APREF discontinuity file, apref_YYDOY.disconts needs to be in the working
-directory.
+The APREF discontinuity file is given with --disconts, or else the latest
+apref_YYDOY.disconts in the working directory is used. It is read and checked
+once for all the roots.
 '''
 
 # Things to think about:
@@ -23,249 +33,374 @@ directory.
 #   * Gaps in and APREF station's time series
 
 from __future__ import print_function
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from glob import glob
-import sys, shutil, datetime
-
-# Make backups of the two files, read in their contents, and open the output
-# files
-stnFile = sys.argv[1] + '_stn.xml'
-msrFile = sys.argv[1] + '_msr.xml'
-shutil.copyfile(stnFile, stnFile + '.bak')
-shutil.copyfile(msrFile, msrFile + '.bak')
-stnLines = [line.rstrip() for line in open(stnFile)]
-msrLines = [line.rstrip() for line in open(msrFile)]
-sf = open(stnFile, 'w')
-mf = open(msrFile, 'w')
-
-# Write the header infromation to the output files
-for i in range(0, 2):
-    stnHdr = stnLines[i].rstrip('\r\n')
-    sf.write(stnHdr + '\n')
-    msrHdr = msrLines[i].rstrip('\r\n')
-    mf.write(msrHdr + '\n')
-
-# Read in the discontinuities
-disconts = {}
-stnsWdiscont = set()
-for discontFile in glob('apref*.disconts'):
-    pass
-for line in open(discontFile):
-    if line[4] == '_':
-        stn = line[0:4]
-        stnsWdiscont.add(stn)
-        try:
-            disconts[stn]
-        except KeyError:
-            disconts[stn] = []
-        yearDoy = line[5:12]
-        disconts[stn].append(yearDoy)
-
-# Read the msr file into measurement blocks
-msrBlocks = []
-block = []
-buildBlock = False
-for msrLine in msrLines[2:]:
-    msrLine = msrLine.rstrip('\r\n')
-    if '<DnaMeasurement>' in msrLine:
-        buildBlock = True
-    if buildBlock:
-        block.append(msrLine)
-    if '</DnaMeasurement>' in msrLine:
-        buildBlock = False
-        msrBlocks.append(block)
-        block = []
-
-# Loop over the measurement blocks
-addStn = set()
-remStn = set()
-ignoreString = '<Ignore>*</Ignore>'
-for msrBlock in msrBlocks:
+import argparse, io, mmap, os
+import re, sys, datetime, time
+import xml.parsers.expat
+from xml.sax.saxutils import escape
+from compressed_io import compression_of, open_file
+
+
+def find_input(fileName):
+    """Returns the name of the input file, which may have the extension of a
+    compressed format appended
+    """
+    for ext in ('', '.gz', '.Z', '.xz'):
+        if os.path.exists(fileName + ext):
+            return fileName + ext
+    raise OSError('There is no file ' + fileName)
+
+
+def output_name(fileName, inputFile, compression):
+    """Returns the name and compression of the output file replacing an input
+    file. Output is compressed as requested, else as the input file is if
+    it is gzip or xz compressed
+    """
+    if compression is None:
+        compression = compression_of(inputFile)
+        if compression == 'Z':
+            compression = None
+    if compression is None:
+        return fileName, None
+    return fileName + '.' + compression, compression
+
+
+def latest_disconts():
+    """Returns the name of the latest APREF discontinuity file,
+    apref_YYDOY.disconts, in the working directory, or None if there is none
+    """
+    def yrDoy(discontFile):
+        match = re.search(r'(\d{2})(\d{3})\.disconts$', discontFile)
+        if match is None:
+            return 0
+        year = int(match.group(1))
+        year += 2000 if year < 94 else 1900
+        return year * 1000 + int(match.group(2))
+    discontFiles = sorted(glob('apref*.disconts'), key=yrDoy)
+    if len(discontFiles) > 1:
+        print('Using %s, the latest of %d discontinuity files' %
+              (discontFiles[-1], len(discontFiles)))
+    return discontFiles[-1] if discontFiles else None
+
+
+def read_disconts(discontFile):
+    """Returns the discontinuity index of an APREF discontinuity file, i.e., a
+    dictionary of the year-DOYs (YYYYDOY) of the discontinuities of each
+    station, sorted once so that renaming is a binary search
+
+    Raises ValueError if a discontinuity does not have a valid year-DOY or
+    there are no discontinuities in the file
+    """
+    disconts = {}
+    with open(discontFile) as f:
+        for lineNo, line in enumerate(f, 1):
+            if line[4:5] != '_':
+                continue
+            yrDoy = line[5:12]
+            if (len(yrDoy) != 7 or not yrDoy.isdigit() or
+                    not 1 <= int(yrDoy[4:]) <= 366):
+                raise ValueError('Invalid discontinuity on line %d of %s: %s'
+                                 % (lineNo, discontFile, line.rstrip()))
+            disconts.setdefault(line[0:4], []).append(yrDoy)
+    if not disconts:
+        raise ValueError('There are no discontinuities in ' + discontFile)
+    for stn in disconts:
+        disconts[stn] = tuple(sorted(disconts[stn]))
+    return disconts
+
+
+def discont_name(name, yrDoy, disconts):
+    """Returns the name of station name in a measurement at yrDoy, i.e., the
+    name with the year-DOY of its latest discontinuity before yrDoy appended,
+    or of its first discontinuity if there is none before yrDoy
+    """
+    discnts = disconts[name]
+    return name + '_' + discnts[max(bisect_left(discnts, yrDoy) - 1, 0)]
+
+
+def dynaml_blocks(lines, tag):
+    """Yield the lines of each <tag> element of a DynaML file in turn, one
+    element at a time, with trailing whitespace removed. Lines outside the
+    elements are skipped
+    """
+    start = '<' + tag + '>'
+    end = '</' + tag + '>'
+    block = []
+    buildBlock = False
+    for line in lines:
+        line = line.rstrip()
+        if start in line:
+            buildBlock = True
+        if buildBlock:
+            block.append(line)
+        if end in line:
+            buildBlock = False
+            yield block
+            block = []
+
+
+def measurement_blocks(f):
+    """Yield the text of each DnaMeasurement element of a DynaML measurement
+    file in turn, from the start of the line it opens on to the end of the
+    line it closes on. The file is read readSize characters at a time, the
+    elements are found without looking at each line, and the text between
+    them is skipped
+
+    An element running on past the text read so far, such as a large Type X
+    cluster, is read in chunks that are kept in a list. Only each new chunk
+    is searched for the end of the element, and the chunks are joined once
+    it is found, so the time taken grows linearly with its size
+    """
+    openTag = '<DnaMeasurement>'
+    closeTag = '</DnaMeasurement>'
+    text = ''
+    pos = 0
+    while True:
+        start = text.find(openTag, pos)
+        end = text.find(closeTag, start) if start >= 0 else -1
+        lineEnd = text.find('\n', end) if end >= 0 else -1
+        if lineEnd >= 0:
+            yield text[text.rfind('\n', 0, start) + 1:lineEnd + 1]
+            pos = lineEnd + 1
+            continue
+        if start < 0:
+            chunk = f.read(readSize)
+            if not chunk:
+                return
+
+            # Keep the last line in case an opening tag runs on into the
+            # next chunk
+            text = text[max(text.rfind('\n') + 1, pos):] + chunk
+            pos = 0
+            continue
+
+        # Read on to the end of the line the element closes on. Offsets are
+        # from the start of the line it opens on, and tail holds the last
+        # characters read, in case the closing tag spans two chunks
+        lineStart = text.rfind('\n', 0, start) + 1
+        parts = [text[lineStart:]]
+        size = len(parts[0])
+        if end >= 0:
+            end -= lineStart
+        tail = parts[0][1 - len(closeTag):]
+        while lineEnd < 0:
+            chunk = f.read(readSize)
+            if not chunk:
+                break
+            if end < 0:
+                found = (tail + chunk).find(closeTag)
+                if found >= 0:
+                    end = size - len(tail) + found
+            if end >= 0:
+                found = chunk.find('\n', max(end + len(closeTag) - size, 0))
+                if found >= 0:
+                    lineEnd = size + found
+            tail = (tail + chunk)[1 - len(closeTag):]
+            parts.append(chunk)
+            size += len(chunk)
+        text = ''.join(parts)
+        if lineEnd < 0:
+            if end >= 0:
+                yield text + '\n'
+            return
+        yield text[:lineEnd + 1]
+        pos = lineEnd + 1
+
+
+def parse_measurement(msrBlock):
+    """Parse the text of a DnaMeasurement element with expat
+
+    Returns (name, text, line, depth) for each of its measurementFields
+    elements in turn: the text of the element, the line it ends on counting
+    from 0, and its depth below DnaMeasurement counting from 0
+    """
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    text = []
+    fields = []
+    depth = 0
+
+    def start(name, attributes):
+        nonlocal depth
+        depth += 1
+        if name in measurementFields:
+            del text[:]
+            parser.CharacterDataHandler = text.append
+
+    def end(name):
+        nonlocal depth
+        depth -= 1
+        if name in measurementFields:
+            parser.CharacterDataHandler = None
+            fields.append((name, ''.join(text), parser.CurrentLineNumber - 1,
+                           depth - 1))
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.Parse(msrBlock.lstrip(), True)
+    return fields
+
+
+@lru_cache(maxsize=1 << 16)
+def epoch_year_doy(epoch):
+    """Returns the year-DOY (YYYYDOY) of a DD.MM.YYYY epoch, or None if it is
+    not a valid date
+
+    Measurement files use few distinct epochs, so the conversions are
+    memoised. Epochs that are not numbers raise ValueError, which lru_cache
+    does not cache
+    """
+    day = int(epoch[0:2])
+    month = int(epoch[3:5])
+    year = int(epoch[6:])
+    try:
+        date = datetime.date(year, month, day)
+    except ValueError:
+        return None
+    return '%d%03d' % (year, date.timetuple().tm_yday)
+
+
+def fix_measurement(msrBlock, disconts, renames):
+    """Returns the text of a measurement with the stations that have
+    discontinuities renamed. Ignored measurements are left as they are, and
+    Type G and X measurements without a valid epoch are ignored instead. The
+    new names are added to renames, which maps each renamed station to the
+    set of its new names
+
+    Measurements that name none of the stations with discontinuities are
+    passed over without being parsed. The others are parsed, and only the
+    lines of the elements that change are rewritten
+    """
+    for name in stationPattern.findall(msrBlock):
+        if name in disconts or '&' in name:
+            break
+    else:
+        return msrBlock
+
+    msrType = None
+    ignoreLine = None
     fix = False
     epochSet = False
-    for line in msrBlock:
-        data = line.lstrip()
-        data = data.rstrip()
-        if ignoreString in data:
-            for line in msrBlock:
-                mf.write(line + '\n')
-            break
-        if 'Type' in data:
-            msrType = data.replace('<Type>', '')
-            msrType = msrType.replace('</Type>', '')
-        if 'Epoch' in data:
-            epoch = data.replace('<Epoch>', '')
-            epoch = epoch.replace('</Epoch>', '')
-            day = int(epoch[0:2])
-            month = int(epoch[3:5])
-            year = int(epoch[6:])
-            try:
-                date = datetime.date(year, month, day)
-                doy = str(date.timetuple().tm_yday)
-                yrDoy = str(year) + ('0' * (3 - len(doy)) + doy)
+    fields = parse_measurement(msrBlock)
+    for name, text, line, depth in fields:
+        if name in stationFields:
+            if text in disconts:
+                fix = True
+        elif depth > 0:
+            continue
+        elif name == 'Ignore':
+            if text.strip() == '*':
+                return msrBlock
+            ignoreLine = line
+        elif name == 'Type':
+            msrType = text.strip()
+        elif name == 'Epoch':
+            epochDoy = epoch_year_doy(text.strip())
+            if epochDoy is not None:
+                yrDoy = epochDoy
                 epochSet = True
-            except ValueError:
-                pass
-        if not fix:
-            if 'First' in data:
-                name = data.replace('<First>', '')
-                name = name.replace('</First>', '')
-                if name in stnsWdiscont:
-                    fix = True
-            if 'Second' in data:
-                name = data.replace('<Second>', '')
-                name = name.replace('</Second>', '')
-                if name in stnsWdiscont:
-                    fix = True
-            if 'Target' in data:
-                name = data.replace('<Target>', '')
-                name = name.replace('</Target>', '')
-                if name in stnsWdiscont:
-                    fix = True
-    if fix and epochSet:
-        for line in msrBlock:
-            data = line.lstrip()
-            data = data.rstrip()
-            if 'First' in data:
-                name = data.replace('<First>', '')
-                name = name.replace('</First>', '')
-                if name in stnsWdiscont:
-                    discnts = disconts[name][:]
-                    discnts.sort()
-                    discnts.reverse()
-                    if yrDoy <= min(discnts):
-                        discnt = min(discnts)
-                        newName = name + '_' + discnt
-                    else:
-                        for discnt in discnts:
-                            if discnt < yrDoy:
-                                newName = name + '_' + discnt
-                                break
-                    line = line.replace(name, newName)
-                    addStn.add(newName)
-                    remStn.add(name)
-            if 'Second' in data:
-                name = data.replace('<Second>', '')
-                name = name.replace('</Second>', '')
-                if name in stnsWdiscont:
-                    discnts = disconts[name][:]
-                    discnts.sort()
-                    discnts.reverse()
-                    if yrDoy <= min(discnts):
-                        discnt = min(discnts)
-                        newName = name + '_' + discnt
-                    else:
-                        for discnt in discnts:
-                            if discnt < yrDoy:
-                                newName = name + '_' + discnt
-                                break
-                    line = line.replace(name, newName)
-                    addStn.add(newName)
-                    remStn.add(name)
-            if 'Target' in data:
-                name = data.replace('<Target>', '')
-                name = name.replace('</Target>', '')
-                if name in stnsWdiscont:
-                    discnts = disconts[name][:]
-                    discnts.sort()
-                    discnts.reverse()
-                    if yrDoy <= min(discnts):
-                        discnt = min(discnts)
-                        newName = name + '_' + discnt
-                    else:
-                        for discnt in discnts:
-                            if discnt < yrDoy:
-                                newName = name + '_' + discnt
-                                break
-                    line = line.replace(name, newName)
-                    addStn.add(newName)
-                    remStn.add(name)
-            mf.write(line + '\n')
-    elif fix and not epochSet:
+    if not fix:
+        return msrBlock
+    lines = msrBlock.split('\n')
+    if not epochSet:
         if msrType == 'G' or msrType == 'X':
-            for line in msrBlock:
-                line = line.replace('<Ignore/>', ignoreString)
-                mf.write(line + '\n')
-        else:
-            yrDoy = '1991001'
-            for line in msrBlock:
-                data = line.lstrip()
-                data = data.rstrip()
-                if 'First' in data:
-                    name = data.replace('<First>', '')
-                    name = name.replace('</First>', '')
-                    if name in stnsWdiscont:
-                        discnts = disconts[name][:]
-                        discnts.sort()
-                        discnts.reverse()
-                        if yrDoy <= min(discnts):
-                            discnt = min(discnts)
-                            newName = name + '_' + discnt
-                        else:
-                            for discnt in discnts:
-                                if discnt < yrDoy:
-                                    newName = name + '_' + discnt
-                                    break
-                        line = line.replace(name, newName)
-                        addStn.add(newName)
-                        remStn.add(name)
-                if 'Second' in data:
-                    name = data.replace('<Second>', '')
-                    name = name.replace('</Second>', '')
-                    if name in stnsWdiscont:
-                        discnts = disconts[name][:]
-                        discnts.sort()
-                        discnts.reverse()
-                        if yrDoy <= min(discnts):
-                            discnt = min(discnts)
-                            newName = name + '_' + discnt
-                        else:
-                            for discnt in discnts:
-                                if discnt < yrDoy:
-                                    newName = name + '_' + discnt
-                                    break
-                        line = line.replace(name, newName)
-                        addStn.add(newName)
-                        remStn.add(name)
-                if 'Target' in data:
-                    name = data.replace('<Target>', '')
-                    name = name.replace('</Target>', '')
-                    if name in stnsWdiscont:
-                        discnts = disconts[name][:]
-                        discnts.sort()
-                        discnts.reverse()
-                        if yrDoy <= min(discnts):
-                            discnt = min(discnts)
-                            newName = name + '_' + discnt
-                        else:
-                            for discnt in discnts:
-                                if discnt < yrDoy:
-                                    newName = name + '_' + discnt
-                                    break
-                        line = line.replace(name, newName)
-                        addStn.add(newName)
-                        remStn.add(name)
-                mf.write(line + '\n')
-    else:
-        for line in msrBlock:
-            mf.write(line + '\n')
-
-# Read the stn file into station blocks
-stnBlocks = []
-block = []
-buildBlock = False
-for stnLine in stnLines[2:]:
-    stnLine = stnLine.rstrip('\r\n')
-    if '<DnaStation>' in stnLine:
-        buildBlock = True
-    if buildBlock:
-        block.append(stnLine)
-    if '</DnaStation>' in stnLine:
-        buildBlock = False
-        stnBlocks.append(block)
-        block = []
-
-# Loop over the station blocks
-for stnBlock in stnBlocks:
+            if ignoreLine is not None:
+                lines[ignoreLine] = lines[ignoreLine].replace('<Ignore/>',
+                                                              ignoreString)
+            return '\n'.join(lines)
+        yrDoy = '1991001'
+    for name, text, line, depth in fields:
+        if name in stationFields and text in disconts:
+            newName = discont_name(text, yrDoy, disconts)
+            lines[line] = lines[line].replace('>' + escape(text) + '<',
+                                              '>' + escape(newName) + '<', 1)
+            renames.setdefault(text, set()).add(newName)
+    return '\n'.join(lines)
+
+
+def fix_measurements(f, disconts, renames):
+    """Yield the text of each measurement in turn, with the stations that
+    have discontinuities renamed
+    """
+    for msrBlock in measurement_blocks(f):
+        yield fix_measurement(msrBlock, disconts, renames)
+
+
+def measurement_ranges(fileName, numChunks):
+    """Returns the byte offsets that split an uncompressed DynaML measurement
+    file into about numChunks ranges, each starting at the beginning of the
+    line of an opening DnaMeasurement tag, with the size of the file last
+    """
+    size = os.path.getsize(fileName)
+    offsets = [0]
+    with open(fileName, 'rb') as f:
+        for k in range(1, numChunks):
+            offset = max(size * k // numChunks, offsets[-1] + 1)
+            f.seek(offset - 1)
+            tail = b''
+            while True:
+                data = f.read(readSize)
+                if not data:
+                    break
+                match = rangePattern.search(tail + data)
+                if match:
+                    offsets.append(offset - 1 - len(tail) + match.start() + 1)
+                    break
+                tail = data[-1024:]
+                offset += len(data)
+            if not data:
+                break
+    offsets.append(size)
+    return offsets
+
+
+def fix_chunk(fileName, start, end, disconts):
+    """Rename the stations in the measurements between two byte offsets of an
+    uncompressed DynaML measurement file
+
+    Returns the text of the fixed measurements and the renames made in them
+    """
+    with open(fileName, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    renames = {}
+    text = ''.join(fix_measurements(io.TextIOWrapper(io.BytesIO(data)),
+                                    disconts, renames))
+    return text, renames
+
+
+def fix_measurements_parallel(fileName, disconts, renames, jobs):
+    """Yield the text of the measurements of an uncompressed DynaML
+    measurement file, with the stations that have discontinuities renamed,
+    in chunks fixed on a pool of jobs processes
+
+    The file is split at measurement boundaries into chunks of at most
+    chunkSize bytes, and at least four per process. The chunks are yielded in
+    order as they are finished, with no more than two per process held at a
+    time, and the renames made in each are merged into renames
+    """
+    numChunks = max(4 * jobs, -(-os.path.getsize(fileName) // chunkSize))
+    offsets = measurement_ranges(fileName, numChunks)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            pending.append(pool.submit(fix_chunk, fileName, start, end,
+                                       disconts))
+            while len(pending) > 2 * jobs or (pending and end == offsets[-1]):
+                text, chunkRenames = pending.popleft().result()
+                for name, newNames in chunkRenames.items():
+                    renames.setdefault(name, set()).update(newNames)
+                yield text
+
+
+def fix_station(stnBlock, renames):
+    """Returns the text of a station block, repeated under each new name of
+    the station, in order, if it has been renamed
+    """
     for line in stnBlock:
         data = line.lstrip()
         data = data.rstrip()
@@ -273,34 +408,321 @@ for stnBlock in stnBlocks:
             name = data.replace('<Name>', '')
             name = name.replace('</Name>', '')
             break
-    if name in remStn:
-        for newName in addStn:
-            if name in newName:
-                for line in stnBlock:
-#                    data = line.lstrip()
-#                    data = data.rstrip()
-#                    if 'XAxis' in data:
-#                        x = data.replace('<XAxis>', '')
-#                        x = x.replace('</XAxis>', '')
-#                        line = line.replace(x, xPos[newName])
-#                    if 'YAxis' in data:
-#                        y = data.replace('<YAxis>', '')
-#                        y = y.replace('</YAxis>', '')
-#                        line = line.replace(y, yPos[newName])
-#                    if 'Height' in data:
-#                        z = data.replace('<Height>', '')
-#                        z = z.replace('</Height>', '')
-#                        line = line.replace(z, zPos[newName])
-                    line = line.replace(name, newName)
-#                    line = line.replace('LLH', 'XYZ')
-#                    line = line.replace('LLh', 'XYZ')
-#                    line = line.replace('UTM', 'XYZ')
-                    sf.write(line + '\n')
+    text = '\n'.join(stnBlock) + '\n'
+    if name not in renames:
+        return text
+    return ''.join(station_variants(text, name, renames))
+
+
+def station_variants(text, name, renames):
+    """Returns the text of a station block under each new name of the
+    station, in order
+    """
+    return [text.replace(name, newName) for newName in sorted(renames[name])]
+
+
+def fix_stations(lines, renames):
+    """Yield the text of each station block in turn, with the stations that
+    have been renamed repeated under each new name
+    """
+    for stnBlock in dynaml_blocks(lines, 'DnaStation'):
+        yield fix_station(stnBlock, renames)
+
+
+def read_station_index(stnFile):
+    """Returns the byte-offset index of an uncompressed DynaML station file
+    from its sidecar file, <stnFile>.idx, or None if there is no sidecar file
+    or it was made for a different size or modification time of the file
+
+    The index is a list of (start, end, name) for each DnaStation element in
+    turn, with the byte range from the start of the line it opens on to the
+    end of the line it closes on
+    """
+    stat = os.stat(stnFile)
+    try:
+        with open(stnFile + '.idx') as f:
+            if f.readline().split() != ['#', str(stat.st_size),
+                                        str(stat.st_mtime_ns)]:
+                return None
+            index = []
+            for line in f:
+                start, end, name = line.rstrip('\n').split(' ', 2)
+                index.append((int(start), int(end), name))
+    except (OSError, ValueError):
+        return None
+    return index
+
+
+def write_station_index(stnFile, index):
+    """Write the byte-offset index of a station file to its sidecar file"""
+    stat = os.stat(stnFile)
+    with open(stnFile + '.idx.tmp', 'w') as f:
+        f.write('# %d %d\n' % (stat.st_size, stat.st_mtime_ns))
+        for start, end, name in index:
+            f.write('%d %d %s\n' % (start, end, name))
+    os.replace(stnFile + '.idx.tmp', stnFile + '.idx')
+
+
+def station_index(stnFile):
+    """Returns the byte-offset index of an uncompressed DynaML station file,
+    as read_station_index does, reusing the sidecar file if it is up to date
+    and otherwise building the index and writing the sidecar file
+    """
+    index = read_station_index(stnFile)
+    if index is not None:
+        return index
+    index = []
+    if os.path.getsize(stnFile):
+        with open(stnFile, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in stationBlockPattern.finditer(data):
+                name = stationNamePattern.search(match.group())
+                name = name.group(1).decode() if name else ''
+                index.append((match.start(), match.end(), name))
+    write_station_index(stnFile, index)
+    return index
+
+
+def has_unstripped_lines(fileName):
+    """Returns whether an uncompressed file has a carriage return, or a line
+    ending in whitespace. The streaming path strips these from every line,
+    but fix_indexed_stations would copy them unchanged
+    """
+    if not os.path.getsize(fileName):
+        return False
+    with open(fileName, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return any(data.find(text) != -1 for text in unstrippedText)
+
+
+def copy_bytes(src, dst, start, end):
+    """Copy the bytes from start to end of the file src to the file dst"""
+    src.seek(start)
+    while start < end:
+        data = src.read(min(end - start, copySize))
+        if not data:
+            break
+        dst.write(data)
+        start += len(data)
+
+
+def fix_indexed_stations(inputFile, outputFile, index, renames):
+    """Write an uncompressed DynaML station file from inputFile to
+    outputFile, with the stations that have been renamed repeated under each
+    new name, using the byte-offset index of inputFile
+
+    Only the DnaStation elements of the renamed stations are read and
+    rewritten. The bytes between them are copied in bulk, unchanged. Returns
+    the byte-offset index of outputFile
+    """
+    newIndex = []
+    shift = 0
+    pos = 0
+    with open(inputFile, 'rb') as src, open(outputFile, 'wb') as out:
+        for start, end, name in index:
+            if name not in renames:
+                newIndex.append((start + shift, end + shift, name))
+                continue
+            copy_bytes(src, out, pos, start)
+            src.seek(start)
+            stnBlock = src.read(end - start).decode().splitlines()
+            text = '\n'.join(line.rstrip() for line in stnBlock) + '\n'
+            newStart = start + shift
+            for newName, variant in zip(sorted(renames[name]),
+                                        station_variants(text, name,
+                                                         renames)):
+                variant = variant.encode()
+                out.write(variant)
+                newIndex.append((newStart, newStart + len(variant), newName))
+                newStart += len(variant)
+            shift = newStart - end
+            pos = end
+        copy_bytes(src, out, pos, os.path.getsize(inputFile))
+    return newIndex
+
+
+def fix_file(inputFile, outputFile, compression, fixElements):
+    """Stream a DynaML file from inputFile to outputFile, passing the file
+    after its header lines to fixElements, which yields the text to write for
+    each element in turn
+    """
+    with open_file(inputFile) as f, \
+            open_file(outputFile, 'w', compression) as out:
+        # Write the header information to the output file
+        for i in range(0, 2):
+            out.write(f.readline().rstrip() + '\n')
+        for text in fixElements(f):
+            out.write(text)
+        out.write('</DnaXmlFormat>\n')
+
+
+ignoreString = '<Ignore>*</Ignore>'
+
+# Number of characters of a measurement file read at a time, and the
+# largest number of bytes fixed at a time by a process with --jobs
+readSize = 1 << 20
+chunkSize = 1 << 26
+rangePattern = re.compile(rb'\n[ \t]*<DnaMeasurement>')
+
+# Patterns of a DnaStation element, from the start of the line it opens on
+# to the end of the line it closes on, and of its name, and the number of
+# bytes of a station file copied at a time
+stationBlockPattern = re.compile(
+    rb'^[^\n]*<DnaStation>.*?</DnaStation>[^\n]*(?:\n|$)', re.M | re.S)
+stationNamePattern = re.compile(rb'<Name>([^<]*)</Name>')
+copySize = 1 << 24
+
+# Text that the streaming path would strip from the lines of a station file
+unstrippedText = (b'\r', b' \n', b'\t\n', b'\f\n', b'\v\n')
+
+# Elements of a measurement read by the parser, and those of them that hold
+# the names of stations
+measurementFields = frozenset(['Type', 'Ignore', 'Epoch', 'First', 'Second',
+                               'Third', 'Target'])
+stationFields = frozenset(['First', 'Second', 'Third', 'Target'])
+stationPattern = re.compile(r'<(?:First|Second|Third|Target)>([^<]*)</')
+
+
+def fix_root(root, disconts, compression=None, jobs=1):
+    """Rename the APREF stations with discontinuities in <root>_stn.xml and
+    <root>_msr.xml, keeping the original files as *.bak
+
+    Both output files are written under temporary names first, and only once
+    both have been written are the original files moved to their backups and
+    the output files moved into place, so a failure leaves the root as it was.
+    An uncompressed station file written back uncompressed is rewritten using
+    its byte-offset index, which is kept in the sidecar file
+    <root>_stn.xml.idx, unless it has CRLF line endings or trailing
+    whitespace. Those files are streamed, as compressed files are, so the
+    output does not depend on the compression of the input
+
+    Returns the renames made, i.e., the set of new names of each station
+    """
+    # The files are streamed one element at a time, so memory does not grow
+    # with their size
+    stnFile = find_input(root + '_stn.xml')
+    msrFile = find_input(root + '_msr.xml')
+    stnOut, stnCompression = output_name(root + '_stn.xml', stnFile,
+                                         compression)
+    msrOut, msrCompression = output_name(root + '_msr.xml', msrFile,
+                                         compression)
+    stnIndex = None
+    if (compression_of(stnFile) is None and stnCompression is None and
+            not has_unstripped_lines(stnFile)):
+        stnIndex = station_index(stnFile)
+
+    # Rename the stations in the measurements, and then add the new stations
+    # to the station file in place of the old ones
+    renames = {}
+    try:
+        if jobs > 1 and compression_of(msrFile) is None:
+            fix_file(msrFile, msrOut + '.tmp', msrCompression,
+                     lambda f: fix_measurements_parallel(msrFile, disconts,
+                                                         renames, jobs))
+        else:
+            fix_file(msrFile, msrOut + '.tmp', msrCompression,
+                     lambda f: fix_measurements(f, disconts, renames))
+        if stnIndex is not None:
+            stnIndex = fix_indexed_stations(stnFile, stnOut + '.tmp',
+                                            stnIndex, renames)
+        else:
+            fix_file(stnFile, stnOut + '.tmp', stnCompression,
+                     lambda f: fix_stations(f, renames))
+    except BaseException:
+        for fileName in (msrOut + '.tmp', stnOut + '.tmp'):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+        raise
+
+    # Move the original files to their backups, so none is left beside an
+    # output file of another name, and the output files into place
+    os.replace(msrFile, msrFile + '.bak')
+    os.replace(stnFile, stnFile + '.bak')
+    os.replace(msrOut + '.tmp', msrOut)
+    os.replace(stnOut + '.tmp', stnOut)
+    if stnIndex is not None:
+        write_station_index(stnOut, stnIndex)
+    return renames
+
+
+def try_fix_root(root, disconts, **options):
+    """Fix the files of a root as fix_root does, returning the seconds taken,
+    the renames made and an error message rather than raising if it fails
+    """
+    start = time.perf_counter()
+    try:
+        renames = fix_root(root, disconts, **options)
+    except Exception as e:
+        return (time.perf_counter() - start, None,
+                '%s: %s' % (type(e).__name__, e))
+    return time.perf_counter() - start, renames, None
+
+
+def report_root(root, seconds, renames, error, errors):
+    """Print the time taken and the renames made for a root, or add its
+    error to errors
+    """
+    if error:
+        errors[root] = error
+        return
+    print('%s: %d stations renamed to %d new names in %.2f s' %
+          (root, len(renames), sum(len(names) for names in renames.values()),
+           seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rename APREF stations with discontinuities in pairs of '
+        'DynaML files')
+    parser.add_argument('roots', metavar='root', nargs='+',
+                        help='The root of the input files')
+    parser.add_argument('--disconts', metavar='FILE', dest='discontFile',
+                        help='The APREF discontinuity file, by default the '
+                        'latest apref_YYDOY.disconts in the working directory')
+    parser.add_argument('--compress', dest='compression', choices=['gz', 'xz'],
+                        help='Compress the output files with gzip or xz')
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int,
+                        default=1,
+                        help='Fix the roots on N processes, or, for a single '
+                        'root, its uncompressed measurement file in chunks')
+    args = parser.parse_args()
+
+    # Read in and check the discontinuities once for all the roots
+    discontFile = args.discontFile or latest_disconts()
+    if discontFile is None:
+        sys.exit('\nThere is no apref*.disconts file in the working '
+                 'directory\n')
+    try:
+        disconts = read_disconts(discontFile)
+    except (OSError, ValueError) as e:
+        sys.exit('\n%s\n' % e)
+
+    # Fix the roots one after another, or spread over a pool of N processes,
+    # reporting the time taken and the renames made in each. Failures are
+    # collected per root and reported once all the roots have been tried
+    errors = {}
+    if args.jobs > 1 and len(args.roots) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(try_fix_root, root, disconts,
+                                   compression=args.compression)
+                       for root in args.roots]
+            results = zip(args.roots, (future.result() for future in futures))
+            for root, (seconds, renames, error) in results:
+                report_root(root, seconds, renames, error, errors)
     else:
-        for line in stnBlock:
-            sf.write(line + '\n')
+        for root in args.roots:
+            seconds, renames, error = try_fix_root(
+                root, disconts, compression=args.compression, jobs=args.jobs)
+            report_root(root, seconds, renames, error, errors)
+
+    if errors:
+        print('%d of %d roots could not be fixed:' %
+              (len(errors), len(args.roots)), file=sys.stderr)
+        for root in args.roots:
+            if root in errors:
+                print('    %s - %s' % (root, errors[root]), file=sys.stderr)
+        sys.exit(1)
+
 
-sf.write('</DnaXmlFormat>\n')
-mf.write('</DnaXmlFormat>\n')
-sf.close()
-mf.close()
+if __name__ == '__main__':
+    main()